@@ -0,0 +1,107 @@
+from collections.abc import Mapping
+from typing import Dict
+
+import numpy as np
+
+# Array-backed lookup tables for the parsed data of a movie. They take a
+# fraction of the memory of dicts and tuples, and can be memory-mapped from
+# snapshot files, so that all worker processes share one copy of them.
+
+# A shown image is identified by its frame and bounding box
+IMAGE_KEY = np.dtype([
+    ("frame", np.int32), ("x1", np.int32), ("y1", np.int32), ("x2", np.int32), ("y2", np.int32)
+])
+
+class Clusters(Mapping):
+    """Clusters of a movie, cluster id -> {
+        "image_data": list of (trajectory_id, frame_index, bounding_box),
+        "n_trajectories", "n_shown_images", "n_total_images"
+    }. The dicts are built when accessed.
+    """
+    def __init__(self, ids, counts, offsets, images):
+        # Sorted cluster ids, and rows of (n_trajectories, n_shown_images, n_total_images)
+        self.ids = ids
+        self.counts = counts
+        # Rows of (trajectory_id, frame, x1, y1, x2, y2) grouped by cluster:
+        # images of the k:th cluster are images[offsets[k]:offsets[k + 1]]
+        self.offsets = offsets
+        self.images = images
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+        return cls(
+            arrays["cluster_ids"],
+            arrays["cluster_counts"],
+            arrays["cluster_offsets"],
+            arrays["cluster_images"],
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "cluster_ids": self.ids,
+            "cluster_counts": self.counts,
+            "cluster_offsets": self.offsets,
+            "cluster_images": self.images,
+        }
+
+    def __getitem__(self, cluster_id: int):
+        k = int(np.searchsorted(self.ids, cluster_id))
+        if k == len(self.ids) or self.ids[k] != cluster_id:
+            raise KeyError(cluster_id)
+        n_trajectories, n_shown_images, n_total_images = self.counts[k].tolist()
+        images = self.images[self.offsets[k]:self.offsets[k + 1]].tolist()
+        return {
+            "image_data": [(ti, frame, box) for ti, frame, *box in images],
+            "n_trajectories": n_trajectories,
+            "n_shown_images": n_shown_images,  # N images that will be send to the frontend
+            "n_total_images": n_total_images,  # Total images in related trajectories
+        }
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+class TrajectoryMap(Mapping):
+    """Maps (frame, *box) -> trajectory id for every shown image of a movie,
+    with a binary search over sorted keys.
+    """
+    def __init__(self, keys, trajectory_ids):
+        self.keys = keys
+        self.trajectory_ids = trajectory_ids
+
+    @classmethod
+    def from_rows(cls, rows, trajectory_ids):
+        """Build from rows of (frame, x1, y1, x2, y2) and their trajectories.
+        Like in a dict, later rows replace earlier rows with the same key.
+        """
+        keys = np.ascontiguousarray(rows, dtype=np.int32).view(IMAGE_KEY).reshape(-1)
+        order = np.argsort(keys, kind="stable")
+        keys, trajectory_ids = keys[order], trajectory_ids[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        return cls(keys[last], trajectory_ids[last].astype(np.int32))
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+        return cls(arrays["trajectory_keys"], arrays["trajectory_ids"])
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"trajectory_keys": self.keys, "trajectory_ids": self.trajectory_ids}
+
+    def __getitem__(self, frame_and_box):
+        try:
+            key = np.array(tuple(frame_and_box), dtype=IMAGE_KEY)
+        except (TypeError, ValueError, OverflowError):
+            raise KeyError(frame_and_box)
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(frame_and_box)
+        return int(self.trajectory_ids[i])
+
+    def __iter__(self):
+        return iter(self.keys.tolist())
+
+    def __len__(self):
+        return len(self.keys)
@@ -0,0 +1,110 @@
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+import time
+import threading
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+class TTLCache(Generic[K, V]):
+    """In-process cache of values that expire ttl seconds after they were
+    loaded. Counts hits and misses.
+    """
+    def __init__(self, ttl: float, max_items: int = 4096):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        # key -> (expiry time, value)
+        self.items: Dict[K, Tuple[float, V]] = {}
+        # Bumped by invalidate, so that loads that were started before it
+        # don't store their (possibly old) values
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K, load: Callable[[], Optional[V]]) -> Optional[V]:
+        """Cached value of key, or the value returned by load(). None values
+        (e.g. database errors) are not cached.
+        """
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] > now:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+        if value is None or self.ttl <= 0:
+            return value
+
+        with self.lock:
+            if generation == self.generation:
+                if len(self.items) >= self.max_items:
+                    self.items = {k: item for k, item in self.items.items() if item[0] > now}
+                if len(self.items) < self.max_items:
+                    self.items[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys: K):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.items.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.items), "ttl": self.ttl}
+
+class CachedCountsClient:
+    """Wraps a DatabaseClient (or WriteBehindClient) so that label counts are
+    read from memory, and from the database at most every ttl seconds.
+
+    Saving annotations through this client invalidates the counts of the
+    movie right away. Global actor counts that are cached for other movies,
+    and counts in other backend processes, are updated when they expire.
+    """
+    def __init__(self, db_client, ttl: float):
+        self.db_client = db_client
+        # movie_id (None: all movies) -> movie_id -> n_labeled_clusters
+        self.annotation_counts: TTLCache[Optional[int], Dict[int, int]] = TTLCache(ttl)
+        # movie_id -> (label -> n_images in all movies, label -> n_images in the movie)
+        self.actor_counts: TTLCache[int, Tuple[Dict[str, int], Dict[str, int]]] = TTLCache(ttl)
+
+    def __getattr__(self, name):
+        return getattr(self.db_client, name)
+
+    def get_annotation_counts(self, movie_id: Optional[int] = None):
+        return self.annotation_counts.get(movie_id, lambda: self.db_client.get_annotation_counts(movie_id))
+
+    def get_actor_counts(self, movie_id: int):
+        def load():
+            count_global, count_movie = self.db_client.get_actor_counts(movie_id)
+            if count_global is None or count_movie is None:
+                return None
+            return count_global, count_movie
+
+        counts = self.actor_counts.get(movie_id, load)
+        return counts if counts is not None else (None, None)
+
+    def invalidate(self, movie_id: int):
+        self.annotation_counts.invalidate(movie_id, None)
+        self.actor_counts.invalidate(movie_id)
+
+    def insert_annotations(self, username, movie_id, *args, **kwargs):
+        try:
+            return self.db_client.insert_annotations(username, movie_id, *args, **kwargs)
+        finally:
+            self.invalidate(movie_id)
+
+    def insert_annotations_batch(self, username, movie_id, annotations):
+        try:
+            return self.db_client.insert_annotations_batch(username, movie_id, annotations)
+        finally:
+            self.invalidate(movie_id)
+
+    def stats(self) -> dict:
+        return {
+            "annotation_counts": self.annotation_counts.stats(),
+            "actor_counts": self.actor_counts.stats(),
+        }
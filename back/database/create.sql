@@ -1,3 +1,11 @@
+-- Versions of the scripts in migrations/ that are applied to this database.
+-- This file always contains all of them.
+CREATE TABLE schema_migrations (
+	"version"		INTEGER PRIMARY KEY,
+	"applied_on"	TIMESTAMP NOT NULL DEFAULT NOW()
+);
+INSERT INTO schema_migrations ("version") VALUES (1), (2);
+
 CREATE TYPE cluster_status AS ENUM ('labeled', 'discarded', 'postponed', 'mixed');
 
 -- same = image shows majority actor of cluster
@@ -18,8 +26,163 @@ CREATE TABLE clusters (
 );
 
 CREATE TABLE images (
-	"cluster_id"	INTEGER REFERENCES clusters(id),
+	"cluster_id"	INTEGER REFERENCES clusters(id) ON DELETE CASCADE,
 	"tag"			VARCHAR(64) NOT NULL,
 	"status"		image_status NOT NULL,
 	"trajectory"	INTEGER NOT NULL
 );
+
+-- One row per user and cluster, so that saving a cluster is a single upsert.
+-- The constraint's index is used when saving, the other two when reading.
+ALTER TABLE clusters ADD CONSTRAINT clusters_user_movie_cluster_key
+	UNIQUE ("username", "movie_id", "cluster_id");
+CREATE INDEX clusters_movie_cluster_idx ON clusters ("movie_id", "cluster_id");
+CREATE INDEX images_cluster_id_idx ON images ("cluster_id");
+
+-- Label counts, kept up to date by the triggers below so that listing movies
+-- and actors doesn't need to scan the clusters and images tables.
+
+-- Number of users that labeled a cluster (label IS NOT NULL)
+CREATE TABLE cluster_label_counts (
+	"movie_id"		INTEGER NOT NULL,
+	"cluster_id"	INTEGER NOT NULL,
+	"n_labels"		INTEGER NOT NULL,
+	PRIMARY KEY ("movie_id", "cluster_id")
+);
+
+-- Number of distinct labeled clusters in a movie
+CREATE TABLE movie_label_counts (
+	"movie_id"				INTEGER PRIMARY KEY,
+	"n_labeled_clusters"	INTEGER NOT NULL
+);
+
+-- Number of 'same' images in 'labeled' clusters, per movie and label
+CREATE TABLE actor_label_counts (
+	"movie_id"		INTEGER NOT NULL,
+	"label"			VARCHAR(64) NOT NULL,
+	"n_images"		INTEGER NOT NULL,
+	PRIMARY KEY ("movie_id", "label")
+);
+
+-- Same as above, summed over all movies
+CREATE TABLE actor_label_totals (
+	"label"			VARCHAR(64) PRIMARY KEY,
+	"n_images"		INTEGER NOT NULL
+);
+
+CREATE FUNCTION add_cluster_label(p_movie_id INTEGER, p_cluster_id INTEGER, p_delta INTEGER)
+RETURNS void AS $$
+DECLARE
+	n INTEGER;
+BEGIN
+	INSERT INTO cluster_label_counts (movie_id, cluster_id, n_labels)
+	VALUES (p_movie_id, p_cluster_id, p_delta)
+	ON CONFLICT (movie_id, cluster_id)
+	DO UPDATE SET n_labels = cluster_label_counts.n_labels + p_delta
+	RETURNING n_labels INTO n;
+
+	-- The movie count changes only when a cluster gets its first label, or loses its last one
+	IF (p_delta > 0 AND n = p_delta) OR (p_delta < 0 AND n = 0) THEN
+		INSERT INTO movie_label_counts (movie_id, n_labeled_clusters)
+		VALUES (p_movie_id, sign(p_delta))
+		ON CONFLICT (movie_id)
+		DO UPDATE SET n_labeled_clusters = movie_label_counts.n_labeled_clusters + sign(p_delta);
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION add_actor_images(p_movie_id INTEGER, p_label VARCHAR(64), p_delta INTEGER)
+RETURNS void AS $$
+BEGIN
+	IF p_delta = 0 THEN
+		RETURN;
+	END IF;
+
+	INSERT INTO actor_label_counts (movie_id, label, n_images)
+	VALUES (p_movie_id, p_label, p_delta)
+	ON CONFLICT (movie_id, label)
+	DO UPDATE SET n_images = actor_label_counts.n_images + p_delta;
+
+	INSERT INTO actor_label_totals (label, n_images)
+	VALUES (p_label, p_delta)
+	ON CONFLICT (label)
+	DO UPDATE SET n_images = actor_label_totals.n_images + p_delta;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Cluster rows: BEFORE DELETE, so that images removed by a cascading delete are
+-- still there to be counted. Images removed by the cascade are then skipped by
+-- the image triggers, because their cluster is gone.
+CREATE FUNCTION clusters_label_counts()
+RETURNS trigger AS $$
+DECLARE
+	n_same INTEGER;
+BEGIN
+	IF TG_OP = 'UPDATE'
+		AND OLD.movie_id = NEW.movie_id AND OLD.cluster_id = NEW.cluster_id
+		AND OLD.label IS NOT DISTINCT FROM NEW.label AND OLD.status = NEW.status THEN
+		RETURN NEW;
+	END IF;
+
+	IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.label IS NOT NULL THEN
+		PERFORM add_cluster_label(OLD.movie_id, OLD.cluster_id, -1);
+		IF OLD.status = 'labeled' THEN
+			SELECT COUNT(*) INTO n_same FROM images WHERE cluster_id = OLD.id AND status = 'same';
+			PERFORM add_actor_images(OLD.movie_id, OLD.label, -n_same);
+		END IF;
+	END IF;
+
+	IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.label IS NOT NULL THEN
+		PERFORM add_cluster_label(NEW.movie_id, NEW.cluster_id, 1);
+		IF NEW.status = 'labeled' THEN
+			SELECT COUNT(*) INTO n_same FROM images WHERE cluster_id = NEW.id AND status = 'same';
+			PERFORM add_actor_images(NEW.movie_id, NEW.label, n_same);
+		END IF;
+	END IF;
+
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER clusters_label_counts_write
+AFTER INSERT OR UPDATE ON clusters
+FOR EACH ROW EXECUTE FUNCTION clusters_label_counts();
+
+CREATE TRIGGER clusters_label_counts_delete
+BEFORE DELETE ON clusters
+FOR EACH ROW EXECUTE FUNCTION clusters_label_counts();
+
+-- Image rows: statement level, so that a batch of images is counted at once
+CREATE FUNCTION images_label_counts()
+RETURNS trigger AS $$
+BEGIN
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM add_actor_images(c.movie_id, c.label, -COUNT(*)::INTEGER)
+		FROM old_images AS i INNER JOIN clusters AS c ON (c.id = i.cluster_id)
+		WHERE i.status = 'same' AND c.status = 'labeled' AND c.label IS NOT NULL
+		GROUP BY c.movie_id, c.label;
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM add_actor_images(c.movie_id, c.label, COUNT(*)::INTEGER)
+		FROM new_images AS i INNER JOIN clusters AS c ON (c.id = i.cluster_id)
+		WHERE i.status = 'same' AND c.status = 'labeled' AND c.label IS NOT NULL
+		GROUP BY c.movie_id, c.label;
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER images_label_counts_insert
+AFTER INSERT ON images REFERENCING NEW TABLE AS new_images
+FOR EACH STATEMENT EXECUTE FUNCTION images_label_counts();
+
+CREATE TRIGGER images_label_counts_update
+AFTER UPDATE ON images REFERENCING OLD TABLE AS old_images NEW TABLE AS new_images
+FOR EACH STATEMENT EXECUTE FUNCTION images_label_counts();
+
+CREATE TRIGGER images_label_counts_delete
+AFTER DELETE ON images REFERENCING OLD TABLE AS old_images
+FOR EACH STATEMENT EXECUTE FUNCTION images_label_counts();
@@ -0,0 +1,81 @@
+"""Apply the scripts in migrations/ that the database doesn't have yet.
+
+Each script runs in its own transaction, together with recording its version
+in schema_migrations. Connection settings are read from the same environment
+variables as the backend: DB_HOST and DB_PASSWORD.
+
+With --wait, connecting is retried until the database is up, e.g. when it
+starts at the same time as the backend container.
+
+Example: DB_PASSWORD=test python back/database/migrate.py --wait 60
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+def list_migrations():
+    """Migration scripts as a sorted list of (version, path). Script names start
+    with their version, like 002_cluster_indexes.sql.
+    """
+    migrations = []
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql")):
+        version = int(os.path.basename(path).split("_")[0])
+        migrations.append((version, path))
+    return sorted(migrations)
+
+def migrate(conn):
+    with conn.cursor() as cursor:
+        # Databases created before versioning don't have the table yet
+        cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            "version" INTEGER PRIMARY KEY,
+            "applied_on" TIMESTAMP NOT NULL DEFAULT NOW()
+        );""")
+        cursor.execute("SELECT version FROM schema_migrations;")
+        applied = {version for version, in cursor.fetchall()}
+    conn.commit()
+
+    for version, path in list_migrations():
+        if version in applied:
+            continue
+        print(f"Applying migration: {os.path.basename(path)}")
+        with open(path, "r") as f:
+            sql = f.read()
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s);", (version,))
+        conn.commit()
+
+def connect(wait: float):
+    """Connect to the database, retrying for up to wait seconds.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            return psycopg2.connect(
+                user="admin",
+                database="db",
+                host=os.environ.get("DB_HOST", "localhost"),
+                password=os.environ["DB_PASSWORD"],
+            )
+        except psycopg2.OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise
+            print(f"Database not reachable yet, retrying: {str(e).strip()}", file=sys.stderr)
+            time.sleep(2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--wait", type=float, default=0, help="seconds to retry connecting (default: 0)")
+    args = parser.parse_args()
+
+    conn = connect(args.wait)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,24 @@
+-- Indexes for the queries that run on every cluster view and save, a unique
+-- row per (username, movie_id, cluster_id) so that saves can upsert, and
+-- cascading deletes from clusters to their images.
+
+-- No writes while duplicates are removed and constraints are added
+LOCK TABLE clusters, images IN SHARE ROW EXCLUSIVE MODE;
+
+ALTER TABLE images
+	DROP CONSTRAINT images_cluster_id_fkey,
+	ADD CONSTRAINT images_cluster_id_fkey
+		FOREIGN KEY ("cluster_id") REFERENCES clusters(id) ON DELETE CASCADE;
+
+-- Concurrent saves could have created duplicate rows. Keep the newest one.
+DELETE FROM clusters AS c
+USING clusters AS newer
+WHERE c.username = newer.username
+	AND c.movie_id = newer.movie_id
+	AND c.cluster_id = newer.cluster_id
+	AND c.id < newer.id;
+
+ALTER TABLE clusters ADD CONSTRAINT clusters_user_movie_cluster_key
+	UNIQUE ("username", "movie_id", "cluster_id");
+CREATE INDEX clusters_movie_cluster_idx ON clusters ("movie_id", "cluster_id");
+CREATE INDEX images_cluster_id_idx ON images ("cluster_id");
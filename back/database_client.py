@@ -1,29 +1,142 @@
 from datetime import datetime
 from collections import defaultdict
+from contextlib import contextmanager
 from typing import Optional
+import functools
+import threading
+import time
 import traceback
 
 import psycopg2
 import psycopg2.extras
 import psycopg2.errors
+import psycopg2.pool
 import pandas as pd
 
+from metrics import REGISTRY
+from profiler import CURRENT_PROFILE
+
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "db_query_duration_seconds", "Time of DatabaseClient calls, including waiting for a connection.", ("query",)
+)
+DB_ERRORS = REGISTRY.counter("db_errors_total", "Failed DatabaseClient calls.", ("query",))
+DB_CONNECTION_WAIT_SECONDS = REGISTRY.histogram(
+    "db_connection_wait_seconds", "Time to check out a healthy connection from the pool."
+)
+DB_RECONNECTS = REGISTRY.counter("db_reconnects_total", "Broken connections that were replaced.")
+
+def timed_query(method):
+    """Time calls of a DatabaseClient method in DB_QUERY_SECONDS, and in the
+    profile of the current request, if it is profiled. Only for methods that
+    run the queries, not for those that call other timed methods.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            DB_QUERY_SECONDS.observe(seconds, query=method.__name__)
+            profile = CURRENT_PROFILE.get()
+            if profile is not None:
+                profile.add_query(method.__name__, start, seconds)
+    return wrapper
+
 class DatabaseClient:
     def __init__(
-        self, host="localhost", port=5432, user="admin", database="db", password=""
+        self, host="localhost", port=5432, user="admin", database="db", password="",
+        pool_size=10, health_check_interval=30.0,
     ):
-        self.conn = psycopg2.connect(
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            pool_size,
             user=user,
             password=password,
             host=host,
             port=port,
             database=database,
         )
-        self.conn.autocommit = False
+        # The pool raises instead of blocking when empty, so count free slots
+        self.slots = threading.BoundedSemaphore(pool_size)
+        # Connections unused for this long (seconds) are checked before use
+        self.health_check_interval = health_check_interval
+        self.last_used = {}
+
+        self.pool_size = pool_size
+        self.n_in_use = 0
+        self.n_in_use_lock = threading.Lock()
+        REGISTRY.gauge("db_pool_size", "Max number of open database connections.", function=lambda: self.pool_size)
+        REGISTRY.gauge(
+            "db_connections_in_use", "Database connections checked out of the pool.", function=lambda: self.n_in_use
+        )
+
+    def close(self, *_):
+        """Close all connections. Extra arguments are ignored so that this can
+        be used as a signal handler.
+        """
+        if self.pool and not self.pool.closed:
+            self.pool.closeall()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self.last_used.get(id(conn), 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-    def close(self):
-        if self.conn:
-            self.conn.close()
+    @contextmanager
+    def connection(self, autocommit=False):
+        """Check out a connection from the pool, for the duration of a request.
+        Broken connections are replaced with new ones (= reconnect).
+
+        Read-only queries can use autocommit, which saves the round-trips for
+        opening and closing a transaction. Errors while checking out a connection
+        are raised as psycopg2.Error, like query errors.
+        """
+        start = time.perf_counter()
+        self.slots.acquire()
+        with self.n_in_use_lock:
+            self.n_in_use += 1
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            # The pool reopens connections that were put back as closed
+            for _ in range(2):
+                if self._is_healthy(conn):
+                    break
+                DB_RECONNECTS.inc()
+                self.last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+                # Already returned, even if getting a new one fails
+                conn = None
+                conn = self.pool.getconn()
+            conn.autocommit = autocommit
+            DB_CONNECTION_WAIT_SECONDS.observe(time.perf_counter() - start)
+            yield conn
+        finally:
+            if conn is not None:
+                broken = conn.closed != 0
+                if not broken and conn.status != psycopg2.extensions.STATUS_READY:
+                    # Never hand out connections in the middle of a transaction
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        broken = True
+                if broken:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn, close=broken)
+            with self.n_in_use_lock:
+                self.n_in_use -= 1
+            self.slots.release()
 
     def insert_annotations(self, username, movie_id, cluster_id, label, images, status, time):
         """Batch insert annotations of images, into database.
@@ -38,177 +151,197 @@ class DatabaseClient:
             status (str): cluster status: 'labeled', 'discarded', 'postponed', 'mixed'
             time (int): processing time the user took to label this cluster, milliseconds
         """
-        insert_success = True
-        cursor = self.conn.cursor()
+        return self.insert_annotations_batch(
+            username, movie_id, [(cluster_id, label, images, status, time)]
+        )
+
+    @timed_query
+    def insert_annotations_batch(self, username, movie_id, annotations, raise_errors=False):
+        """Save annotations of many clusters of a movie in one transaction, so
+        either all of them are saved or none.
+
+        Args:
+            annotations (List): tuples of (cluster_id, label, images, status, time),
+                see insert_annotations. If a cluster is in the list many times,
+                the last annotation is saved and processing times add up.
+            raise_errors (bool): raise database errors instead of returning
+                False, so that the caller can tell what went wrong
+        """
+        # Clusters in initial state (=everything empty/unchanged) are not
+        # inserted, but only removed to save db space/performance
+        is_default = lambda label, images, status: (
+            label is None and status == "labeled" and all(img[1] == "same" for img in images)
+        )
 
-        # Determine if the cluster is in initial state (=everything empty/unchanged)
-        # If yes, nothing will be inserted, but only removed to save db space/performance
-        is_default = True
-        is_default = is_default and label is None
-        is_default = is_default and status == "labeled"
-        is_default = is_default and all(img[1] == "same" for img in images)
+        # Same result as saving the annotations one by one: the last one of each
+        # cluster is saved, with the processing times after its last removal
+        latest = {}  # cluster_id -> (annotation or None if removed, removed before)
+        for cluster_id, label, images, status, time in annotations:
+            if is_default(label, images, status):
+                latest[cluster_id] = (None, True)
+                continue
+            previous, removed_before = latest.get(cluster_id, (None, False))
+            if previous is not None:
+                time += previous[4]
+            latest[cluster_id] = ((cluster_id, label, images, status, time), removed_before)
+        removed = [cluster_id for cluster_id, (_, removed_before) in latest.items() if removed_before]
+        saved = [annotation for annotation, _ in latest.values() if annotation is not None]
 
+        insert_success = True
         try:
-            # Check if cluster exists already
-            q1 = """SELECT id, processing_time
-                FROM clusters
-                WHERE username = %s AND movie_id = %s AND cluster_id = %s;
-                """
-            cursor.execute(q1, (username, movie_id, cluster_id))
-            result = cursor.fetchone()
-
-            # Delete the old records if they existed
-            existed = result is not None
-            if existed:
-                db_cluster_id, time_so_far = result
-                cursor.execute("DELETE FROM images WHERE cluster_id = %s;", (db_cluster_id,))
-                cursor.execute("DELETE FROM clusters WHERE id = %s;", (db_cluster_id,))
-
-                # Add up so that processing time is the total time for this user
-                time += time_so_far
-
-            if not is_default:
-                # Create cluster (or recreate...)
-                q2 = """INSERT INTO
-                    clusters (username, movie_id, cluster_id, status, label, n_images, processing_time)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id;
-                """
-                cursor.execute(q2, (username, movie_id, cluster_id, status, label, len(images), time))
-                db_cluster_id = cursor.fetchone()[0]
-
-                # Add images that were in the cluster.
-                # Image list - tuples (tag: str, status: str, trajectory: int)
-                q3 = "INSERT INTO images (cluster_id, tag, status, trajectory) VALUES %s;"
-                psycopg2.extras.execute_values(
-                    cursor, q3, [(db_cluster_id, tag, status, t_id) for tag, status, t_id in images],
-                    template=None, page_size=100,
-                )
-
-            self.conn.commit()
+            with self.connection() as conn, conn.cursor() as cursor:
+                if removed:
+                    # Remove old records, if any. Images are deleted by cascade.
+                    q1 = """DELETE FROM clusters
+                        WHERE username = %s AND movie_id = %s AND cluster_id = ANY(%s);
+                    """
+                    cursor.execute(q1, (username, movie_id, removed))
+
+                if saved:
+                    # Create clusters, or update those that this user saved before.
+                    # Processing time adds up to the total time for this user.
+                    q2 = """INSERT INTO
+                        clusters (username, movie_id, cluster_id, status, label, n_images, processing_time)
+                        VALUES %s
+                        ON CONFLICT (username, movie_id, cluster_id) DO UPDATE SET
+                            status = EXCLUDED.status,
+                            label = EXCLUDED.label,
+                            n_images = EXCLUDED.n_images,
+                            created_on = NOW(),
+                            processing_time = clusters.processing_time + EXCLUDED.processing_time
+                        RETURNING cluster_id, id;
+                    """
+                    rows = psycopg2.extras.execute_values(cursor, q2, [
+                        (username, movie_id, cluster_id, status, label, len(images), time)
+                        for cluster_id, label, images, status, time in saved
+                    ], page_size=len(saved), fetch=True)
+                    db_cluster_ids = dict(rows)
+
+                    # Replace images that were in the clusters.
+                    # Image list - tuples (tag: str, status: str, trajectory: int)
+                    cursor.execute(
+                        "DELETE FROM images WHERE cluster_id = ANY(%s);", (list(db_cluster_ids.values()),)
+                    )
+                    q3 = "INSERT INTO images (cluster_id, tag, status, trajectory) VALUES %s;"
+                    psycopg2.extras.execute_values(cursor, q3, [
+                        (db_cluster_ids[cluster_id], tag, image_status, t_id)
+                        for cluster_id, _, images, _, _ in saved
+                        for tag, image_status, t_id in images
+                    ], page_size=1000)
+
+                conn.commit()
         except psycopg2.Error as e:
             insert_success = False
-            self.conn.rollback()
+            DB_ERRORS.inc(query="insert_annotations_batch")
+            if raise_errors:
+                raise
             traceback.print_exc()
-        finally:
-            cursor.close()
-            return insert_success
+
+        # Failed transactions are rolled back when the connection is returned
+        return insert_success
 
     def get_annotations(self, username, movie_id, cluster_id):
-        cursor = self.conn.cursor()
-        q1 = """SELECT id, username, label, status, n_images, EXTRACT(EPOCH FROM created_on)
-            FROM clusters
-            WHERE movie_id = %s AND cluster_id = %s;
+        """Get the annotation of a cluster, preferring the one saved by username.
+        Returns an empty dict if nobody annotated the cluster, None on errors.
         """
-
-        try:
-            cursor.execute(q1, (movie_id, cluster_id))
-        except psycopg2.errors.InFailedSqlTransaction as err:
-            traceback.print_exc()
+        annotations = self.get_annotations_batch(username, movie_id, [cluster_id])
+        if annotations is None:
             return None
+        return annotations.get(cluster_id, {})
 
-        results = cursor.fetchall()
-        if not results:
-            return {}
-
-        # Find result by current user, if it existed
-        first_result = results[0]
-        for result in results[1:]:
-            if result[1] == username:
-                first_result = result
-                break
+    @timed_query
+    def get_annotations_batch(self, username, movie_id, cluster_ids):
+        """Get annotations of many clusters of a movie in one query. For each
+        cluster, the annotation saved by username is preferred.
 
-        db_cluster_id, cluster_user, label, cluster_status, n_images, created_on = first_result
+        Returns a dict: cluster_id -> annotation, for annotated clusters only.
+        """
+        # One row per cluster: picked with DISTINCT ON, then its images are
+        # aggregated into JSON so that everything comes in a single round-trip
+        q = """SELECT c.cluster_id, c.username, c.label, c.status, c.created_on, i.images
+            FROM (
+                SELECT DISTINCT ON (cluster_id)
+                    id, cluster_id, username, label, status, EXTRACT(EPOCH FROM created_on) AS created_on
+                FROM clusters
+                WHERE movie_id = %(movie_id)s AND cluster_id = ANY(%(cluster_ids)s)
+                ORDER BY cluster_id, (username = %(username)s) DESC, id
+            ) AS c
+            LEFT JOIN LATERAL (
+                SELECT json_agg(json_build_array(tag, status)) AS images
+                FROM images
+                WHERE images.cluster_id = c.id
+            ) AS i ON TRUE;
+        """
+        params = {"movie_id": movie_id, "cluster_ids": list(cluster_ids), "username": username}
 
-        q2 = "SELECT tag, status FROM images WHERE cluster_id = %s;"
         try:
-            cursor.execute(q2, (db_cluster_id,))
-        except psycopg2.errors.InFailedSqlTransaction as err:
+            with self.connection(autocommit=True) as conn, conn.cursor() as cursor:
+                cursor.execute(q, params)
+                results = cursor.fetchall()
+        except psycopg2.Error as err:
+            DB_ERRORS.inc(query="get_annotations_batch")
             traceback.print_exc()
             return None
 
-        images = cursor.fetchall()
-        # Psycopg opens transactions even with SELECT queries, so we close it here:
-        self.conn.commit()
-        cursor.close()
-
         return {
-            "movie_id": movie_id,
-            "cluster_id": cluster_id,
-            "username": cluster_user,
-            "label": label,
-            "status": cluster_status,
-            "created_on": int(created_on),
-            "images": images,  # tuples (image_tag: str, status: str)
+            cluster_id: {
+                "movie_id": movie_id,
+                "cluster_id": cluster_id,
+                "username": cluster_user,
+                "label": label,
+                "status": cluster_status,
+                "created_on": int(created_on),
+                # tuples (image_tag: str, status: str)
+                "images": [tuple(image) for image in images or []],
+            }
+            for cluster_id, cluster_user, label, cluster_status, created_on, images in results
         }
 
+    @timed_query
     def get_annotation_counts(self, movie_id: Optional[int] = None):
         """Return count of how many clusters have been labeled, per movie.
+        Counts are maintained by triggers, see database/create.sql.
         """
         movie_clause = ""
         if movie_id is not None:
-            movie_clause = f"AND movie_id = {movie_id}"
+            movie_clause = "WHERE movie_id = %(movie_id)s"
 
-        q = f"""SELECT movie_id, COUNT(DISTINCT cluster_id)
-            FROM clusters
-            WHERE label IS NOT NULL {movie_clause}
-            GROUP BY movie_id;
-        """
+        q = f"SELECT movie_id, n_labeled_clusters FROM movie_label_counts {movie_clause};"
 
         movie_counts = None
-        with self.conn.cursor() as cursor:
-            try:
-                cursor.execute(q)
+        try:
+            with self.connection(autocommit=True) as conn, conn.cursor() as cursor:
+                cursor.execute(q, {"movie_id": movie_id})
                 result = cursor.fetchall()
-                # Psycopg opens transactions even with SELECT queries, so we close it here:
-                self.conn.commit()
-                counts = {movie_id: count for movie_id, count in result}
-                movie_counts = defaultdict(lambda: 0, counts)
-            except psycopg2.errors.InFailedSqlTransaction as err:
-                traceback.print_exc()
+            counts = {movie_id: count for movie_id, count in result}
+            movie_counts = defaultdict(lambda: 0, counts)
+        except psycopg2.Error as err:
+            DB_ERRORS.inc(query="get_annotation_counts")
+            traceback.print_exc()
 
         return movie_counts
 
+    @timed_query
     def get_actor_counts(self, movie_id: int):
         """Get labeled images count on movie level and global level, for each
         every actor in the database.
+
+        Counts images labeled in the tool (usually 2x trajectories in a cluster),
+        maintained by triggers, see database/create.sql.
         """
-        def get_counts(movie_id: Optional[int] = None):
-            """Utility function.
-            """
-            movie_clause = ""
-            if movie_id is not None:
-                movie_clause = f"AND movie_id = {movie_id}"
-
-            # Query to get actor level image counts
-            # Counts images labeled in the tool (usually 2x trajectories in a cluster)
-            q = f"""SELECT label, COUNT(trajectory)
-                FROM (
-                    SELECT id, movie_id, label FROM clusters
-                    WHERE status = 'labeled' AND label IS NOT NULL {movie_clause}
-                ) AS clusters
-                INNER JOIN (
-                    SELECT * FROM images
-                    WHERE status = 'same'
-                ) AS images
-                ON (clusters.id = images.cluster_id)
-                GROUP BY label;"""
-
-            actor_counts = None
-            with self.conn.cursor() as cursor:
-                try:
-                    cursor.execute(q)
-                    result = cursor.fetchall()
-                    # Psycopg opens transactions even with SELECT queries, so we close it here:
-                    self.conn.commit()
-                    counts = {actor_id: count for actor_id, count in result}
-                    actor_counts = defaultdict(lambda: 0, counts)
-                except psycopg2.errors.InFailedSqlTransaction as err:
-                    traceback.print_exc()
-
-            return actor_counts
-
-        count_global = get_counts()
-        count_movie = get_counts(movie_id)
+        q_global = "SELECT label, n_images FROM actor_label_totals;"
+        q_movie = "SELECT label, n_images FROM actor_label_counts WHERE movie_id = %s;"
+
+        count_global, count_movie = None, None
+        try:
+            with self.connection(autocommit=True) as conn, conn.cursor() as cursor:
+                cursor.execute(q_global)
+                count_global = defaultdict(lambda: 0, cursor.fetchall())
+                cursor.execute(q_movie, (movie_id,))
+                count_movie = defaultdict(lambda: 0, cursor.fetchall())
+        except psycopg2.Error as err:
+            count_global, count_movie = None, None
+            DB_ERRORS.inc(query="get_actor_counts")
+            traceback.print_exc()
 
         return count_global, count_movie
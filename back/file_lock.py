@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+import os
+import fcntl
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive lock between processes (e.g. backend workers), held on a lock
+    file at path. If the lock file can't be created, nothing is locked, so
+    callers must still write their results atomically.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        yield
+        return
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
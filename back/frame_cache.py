@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from typing import Optional
+import os
+import fcntl
+import hashlib
+import tempfile
+import threading
+import time
+
+# Disk cache eviction leaves this fraction of its max size, so that workers
+# don't scan the directory on every write
+EVICT_TO = 0.9
+
+class MemoryCache:
+    """In-process LRU cache of bytes, bounded by total size in bytes.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.n_bytes -= len(old)
+            self.items[key] = value
+            self.n_bytes += len(value)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+class DiskCache:
+    """Files on disk, named by digest and evicted in least recently used order
+    when their total size exceeds max_bytes.
+
+    Backend workers share the directory and its max_bytes. Each one counts what
+    it writes on top of the size at its last scan of the directory. When that
+    goes over max_bytes, it rescans the directory under a file lock, and evicts
+    the least recently used files of all workers (by mtime) down to EVICT_TO
+    of max_bytes.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.evicting = False
+        os.makedirs(directory, exist_ok=True)
+        self.lock_path = os.path.join(directory, "evict.lock")
+
+        # Pick up files from earlier runs and other workers
+        self.n_bytes = sum(size for _, _, size in self._scan())
+
+    def _scan(self):
+        """(mtime, path, size) of the cached files.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if path == self.lock_path:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    if name.endswith(".tmp"):
+                        # Left over from an interrupted write, unless another
+                        # backend worker is writing it right now
+                        if stat.st_mtime < time.time() - 60:
+                            os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    # Removed by another backend worker
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _path(self, digest: str):
+        # Two-level fan out, to keep directories small
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpeg")
+
+    def get(self, digest: str):
+        path = self._path(digest)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+
+        # mtime is the recency of use, shared by workers and kept over restarts
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def contains(self, digest: str):
+        return os.path.exists(self._path(digest))
+
+    def put(self, digest: str, value: bytes):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write atomically so that readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.n_bytes += len(value)
+            if self.n_bytes <= self.max_bytes or self.evicting:
+                return
+            self.evicting = True
+            counted = self.n_bytes
+        try:
+            n_bytes = self._evict()
+            with self.lock:
+                # Keep what was written during the scan
+                self.n_bytes += n_bytes - counted
+        finally:
+            with self.lock:
+                self.evicting = False
+
+    def _evict(self):
+        """Evict files of all workers down to EVICT_TO of max_bytes. Returns
+        the size of the directory after.
+        """
+        with open(self.lock_path, "a") as lock_file:
+            # One worker at a time, others would evict the same files
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            entries = sorted(self._scan())
+            n_bytes = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if n_bytes <= EVICT_TO * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                n_bytes -= size
+        return n_bytes
+
+class FrameCache:
+    """Two-tier cache for rendered frames: memory first, then disk.
+
+    Entries are addressed by a digest of the render key, which fully determines
+    the rendered bytes. The digest doubles as a strong ETag, so revalidation
+    requests can be answered without touching either tier.
+    """
+    def __init__(self, memory_bytes: int, disk_dir: Optional[str] = None, disk_bytes: int = 0):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(disk_dir, disk_bytes) if disk_dir and disk_bytes > 0 else None
+
+    @staticmethod
+    def digest(key: str):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, digest: str):
+        value = self.memory.get(digest)
+        if value is None and self.disk is not None:
+            value = self.disk.get(digest)
+            if value is not None:
+                self.memory.put(digest, value)
+        return value
+
+    def contains(self, digest: str):
+        if self.memory.get(digest) is not None:
+            return True
+        return self.disk is not None and self.disk.contains(digest)
+
+    def put(self, digest: str, value: bytes):
+        self.memory.put(digest, value)
+        if self.disk is not None:
+            try:
+                self.disk.put(digest, value)
+            except OSError:
+                print(f"Could not write frame to disk cache: {digest}")
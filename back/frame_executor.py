@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import threading
+
+class FrameExecutor:
+    """Dedicated thread pool for blocking OpenCV work (decoding, resizing and
+    encoding frames), so that it doesn't compete with the other endpoints for
+    the default threadpool. OpenCV releases the GIL, so threads run in parallel.
+
+    The number of queued + running tasks is limited. When the limit is hit,
+    submit() returns None and the caller should shed load.
+    """
+    def __init__(self, n_workers=4, max_queued=32):
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="frames")
+        self.slots = threading.BoundedSemaphore(n_workers + max_queued)
+        # Queued + running tasks
+        self.n_pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in the pool. Returns an awaitable for the result, or
+        None if the pool is saturated.
+        """
+        if not self.slots.acquire(blocking=False):
+            return None
+        with self.lock:
+            self.n_pending += 1
+
+        def done():
+            with self.lock:
+                self.n_pending -= 1
+            self.slots.release()
+
+        # Task runs in the context of the request, e.g. with its profile
+        context = contextvars.copy_context()
+
+        def task():
+            # Slot is freed when work finishes, even if the request was dropped
+            try:
+                return context.run(fn, *args)
+            finally:
+                done()
+
+        try:
+            return asyncio.wrap_future(self.executor.submit(task))
+        except:
+            done()
+            raise
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
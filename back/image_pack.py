@@ -0,0 +1,139 @@
+"""Pack the face images of movies into one archive file per movie.
+
+A *-data directory has a file per face image in images/, which makes for
+tens of thousands of small files per movie. The pack is one file with the
+images concatenated (images.pack), and an index of the frame, box, offset
+and length of each image (images.pack.index.npy). When a movie has a pack,
+the backend reads its images from the pack instead of from images/.
+
+Example: python back/image_pack.py /path/to/data --movie 1234
+"""
+from typing import List, Optional
+import os
+import re
+import glob
+import argparse
+
+import numpy as np
+
+from cluster_data import IMAGE_KEY
+
+PACK_NAME = "images.pack"
+INDEX_NAME = "images.pack.index.npy"
+
+# Index entries are sorted by key
+PACK_ENTRY = np.dtype([("key", IMAGE_KEY), ("offset", np.int64), ("length", np.int64)])
+
+def has_pack(dir: str):
+    return os.path.exists(os.path.join(dir, INDEX_NAME))
+
+def list_images(images_dir: str, movie_id: int):
+    """File names of the face images in a directory (see img_tag), and their
+    rows (frame, x1, y1, x2, y2) as an (n, 5) array.
+    """
+    pattern = re.compile(rf"{movie_id}:(-?\d+):(-?\d+)_(-?\d+)_(-?\d+)_(-?\d+)\.jpeg")
+    names, rows = [], []
+    for name in sorted(os.listdir(images_dir)):
+        match = pattern.fullmatch(name)
+        if match:
+            names.append(name)
+            rows.append(match.groups())
+    return names, np.array(rows, dtype=np.int64).reshape(-1, 5)
+
+def read_pack_boxes(dir: str):
+    """Frame and box of every image in the pack of a *-data directory, like
+    movie_data.read_image_boxes.
+    """
+    keys = np.load(os.path.join(dir, INDEX_NAME), mmap_mode="r")["key"]
+    return np.stack([keys[name] for name in IMAGE_KEY.names], axis=1).astype(np.int64)
+
+def build_pack(dir: str, movie_id: int):
+    """Write the images of a *-data directory into a pack. The index is
+    written last, so a pack is only used once it is complete.
+    """
+    names, rows = list_images(os.path.join(dir, "images"), movie_id)
+    entries = np.zeros(len(rows), dtype=PACK_ENTRY)
+    entries["key"] = np.ascontiguousarray(rows, dtype=np.int32).view(IMAGE_KEY).reshape(-1)
+    order = np.argsort(entries["key"], kind="stable")
+
+    pack_path = os.path.join(dir, PACK_NAME)
+    index_path = os.path.join(dir, INDEX_NAME)
+    offset = 0
+    with open(f"{pack_path}.tmp", "wb") as f:
+        for i in order:
+            with open(os.path.join(dir, "images", names[i]), "rb") as image:
+                content = image.read()
+            f.write(content)
+            entries["offset"][i] = offset
+            entries["length"][i] = len(content)
+            offset += len(content)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(f"{index_path}.tmp", "wb") as f:
+        np.save(f, entries[order])
+
+    # A new pack is never used with the index of an old one
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.replace(f"{pack_path}.tmp", pack_path)
+    os.replace(f"{index_path}.tmp", index_path)
+    return len(entries), offset
+
+class ImagePack:
+    """Reads images from the pack of a movie, with os.pread on a file
+    descriptor that is shared by all threads.
+    """
+    def __init__(self, dir: str):
+        self.entries = np.load(os.path.join(dir, INDEX_NAME), mmap_mode="r")
+        self.keys = self.entries["key"]
+        self.fd = os.open(os.path.join(dir, PACK_NAME), os.O_RDONLY)
+
+    def get(self, frame: int, box: List[int]) -> Optional[bytes]:
+        try:
+            key = np.array((frame, *box), dtype=IMAGE_KEY)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        entry = self.entries[i]
+        return os.pread(self.fd, int(entry["length"]), int(entry["offset"]))
+
+    def close(self):
+        os.close(self.fd)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("data_dir", help="directory with the *-data directories of movies")
+    parser.add_argument("--movie", type=int, action="append", help="only this movie (can be repeated)")
+    parser.add_argument("--remove-images", action="store_true",
+        help="remove images/ of a movie once its pack is written and checked")
+    args = parser.parse_args()
+
+    for dir in sorted(glob.glob(os.path.join(args.data_dir, "*-data"))):
+        movie_id = int(os.path.basename(dir).split("-")[0])
+        if args.movie and movie_id not in args.movie:
+            continue
+        images_dir = os.path.join(dir, "images")
+        if not os.path.isdir(images_dir):
+            print(f"No images/ directory, skipping: {dir}")
+            continue
+
+        n_images, n_bytes = build_pack(dir, movie_id)
+        print(f"Packed {n_images} images ({n_bytes / 2**20:.1f} MB): {dir}")
+
+        if args.remove_images:
+            names, rows = list_images(images_dir, movie_id)
+            pack = ImagePack(dir)
+            for name, (frame, *box) in zip(names, rows.tolist()):
+                with open(os.path.join(images_dir, name), "rb") as f:
+                    assert pack.get(frame, box) == f.read(), f"Pack differs from image: {name}"
+            pack.close()
+            for name in names:
+                os.remove(os.path.join(images_dir, name))
+            if not os.listdir(images_dir):
+                os.rmdir(images_dir)
+            print(f"Removed {len(names)} images from {images_dir}")
+
+if __name__ == "__main__":
+    main()
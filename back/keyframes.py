@@ -0,0 +1,121 @@
+from bisect import bisect_right
+from typing import Dict, List, Optional
+import os
+import json
+import shutil
+import subprocess
+import threading
+import traceback
+
+from file_lock import file_lock
+
+def probe_keyframes(movie_path: str, fps: float):
+    """Find frame indices of all keyframes in a movie with ffprobe. Only packet
+    headers are read, so nothing is decoded.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", movie_path,
+    ]
+    output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+
+    # Lines look like: 12.480000,K_
+    packets = []
+    for line in output.splitlines():
+        pts_str, flags = (line.split(",") + [""])[:2]
+        try:
+            packets.append((float(pts_str), "K" in flags))
+        except ValueError:
+            pass
+
+    if not packets:
+        return []
+
+    # Frame indices (as used by cv2) are counted from the first presented frame
+    start = min(pts for pts, _ in packets)
+    return sorted({round((pts - start) * fps) for pts, is_key in packets if is_key})
+
+def plan_reads(frame_indices: List[int], keyframes: Optional[List[int]]):
+    """Group requested frames by the keyframe that starts their GOP, so that
+    every GOP is decoded at most once when the groups are read in order.
+
+    Returns a list of tuples: (keyframe_index, [frame_index, ...])
+    """
+    frames = sorted(set(frame_indices))
+    if not keyframes:
+        # Without an index, all frames are read forward in one pass
+        return [(frames[0], frames)] if frames else []
+
+    groups = []
+    for frame_index in frames:
+        keyframe = gop_start(keyframes, frame_index)
+        if groups and groups[-1][0] == keyframe:
+            groups[-1][1].append(frame_index)
+        else:
+            groups.append((keyframe, [frame_index]))
+    return groups
+
+def gop_start(keyframes: List[int], frame_index: int):
+    """Keyframe preceding (or at) frame_index.
+    """
+    i = bisect_right(keyframes, frame_index)
+    return keyframes[i - 1] if i > 0 else 0
+
+class KeyframeIndex:
+    """Keyframe positions of each movie, built in the background and cached on
+    disk as <movie_id>-keyframes.json, next to the movie's data directory.
+    """
+    def __init__(self):
+        self.keyframes: Dict[int, List[int]] = {}
+
+    def get(self, movie_id: int):
+        return self.keyframes.get(movie_id)
+
+    def _load_or_build(self, movie_id: int, data_path: str, movie_path: str, fps: float):
+        cache_path = os.path.join(os.path.dirname(data_path), f"{movie_id}-keyframes.json")
+        stat = os.stat(movie_path)
+        # Cache is invalidated when the movie file changes
+        source = {"movie": os.path.basename(movie_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+        # Backend workers that start together probe each movie only once
+        with file_lock(f"{cache_path}.lock"):
+            if os.path.exists(cache_path):
+                with open(cache_path, "r") as f:
+                    cached = json.load(f)
+                if cached.get("source") == source and cached.get("fps") == fps:
+                    return cached["keyframes"]
+
+            keyframes = probe_keyframes(movie_path, fps)
+            try:
+                # Written atomically, so that an interrupted write can't break the cache
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"source": source, "fps": fps, "keyframes": keyframes}, f)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                print(f"Could not write keyframe cache: {cache_path}")
+            return keyframes
+
+    def build(self, dir_data: Dict[int, dict]):
+        """Build (or load) the index for each movie that has a movie file.
+        """
+        if shutil.which("ffprobe") is None:
+            # Frames are still read without an index, just without planning
+            print("ffprobe not found, keyframe index disabled.")
+            return
+
+        for movie_id, data in list(dir_data.items()):
+            if data["movie_path"] is None:
+                continue
+            try:
+                self.keyframes[movie_id] = self._load_or_build(
+                    movie_id, data["path"], data["movie_path"], data["fps"]
+                )
+            except Exception:
+                print(f"Keyframe index failed for: {movie_id}")
+                traceback.print_exc()
+
+    def build_in_background(self, dir_data: Dict[int, dict]):
+        thread = threading.Thread(target=self.build, args=(dir_data,), daemon=True)
+        thread.start()
+        return thread
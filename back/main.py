@@ -1,27 +1,46 @@
 from typing import List
+from collections import defaultdict
 import os
-import glob
-import json
 import signal
-import io
+import time
+import asyncio
+import threading
 import base64
+import struct
 
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, FileResponse, StreamingResponse
+from fastapi.responses import Response, FileResponse
 import pandas as pd
+import numpy as np
 import cv2
 
 from database_client import DatabaseClient
-from models.cluster_labels import ClusterLabels
+from write_behind import WriteBehindClient
+from count_cache import CachedCountsClient
+from models.cluster_labels import ClusterLabels, BatchClusterLabels
+from models.profile_settings import ProfileSettings
+from video_pool import VideoPool, FRAME_PHASE_SECONDS
+from keyframes import KeyframeIndex
+from frame_cache import FrameCache
+from prefetch import FramePrefetcher
+from image_pack import ImagePack, has_pack
+from movie_data import MovieRegistry, img_tag, read_datadir, read_summaries
+from snapshot import source_stamps, save_dataframes, load_dataframes
+from frame_executor import FrameExecutor
+from metrics import REGISTRY, MetricsMiddleware, SharedMetrics, render
+from profiler import Profiler, ProfilerMiddleware, ProfiledRoute, profiled, folded
 
 # Create web app and database connection
 app = FastAPI()
+# Endpoints are sampled when their request is profiled
+app.router.route_class = ProfiledRoute
 db_client = DatabaseClient(
     user="admin",
     database="db",
     host=os.environ.get("DB_HOST", "localhost"),
     password=os.environ["DB_PASSWORD"],
+    pool_size=int(os.environ.get("DB_POOL_SIZE", 10)),
 )
 signal.signal(signal.SIGINT, db_client.close)
 signal.signal(signal.SIGTERM, db_client.close)
@@ -33,6 +52,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Request latencies and requests in flight, per route
+app.add_middleware(MetricsMiddleware, registry=REGISTRY, routes=lambda: app.routes)
 
 # Username to use if no name was given by http basic auth
 DEFAULT_USER = "unknown"
@@ -46,40 +67,146 @@ PREDICTION_MIN_P = 0.40
 # Max resolution (width or height) when sending a frame to the frontend
 FRAME_MAX_RES = 512
 
+# Quality of rendered frame jpegs (0-100)
+FRAME_JPEG_QUALITY = 75
+
+# Films are checked for changes at most this often, so the ETags of frames of
+# a replaced film change within this time
+FILM_STAT_SECONDS = 5.0
+
+# Max number of open video decoders (all movies), and idle decoders kept per movie
+VIDEO_POOL_SIZE = int(os.environ.get("VIDEO_POOL_SIZE", 16))
+VIDEO_POOL_PER_MOVIE = int(os.environ.get("VIDEO_POOL_PER_MOVIE", 2))
+
+# Rendered frames are cached in memory, and on disk under CACHE_DIR
+FRAME_CACHE_MEMORY_MB = int(os.environ.get("FRAME_CACHE_MEMORY_MB", 64))
+FRAME_CACHE_DISK_MB = int(os.environ.get("FRAME_CACHE_DISK_MB", 1024))
+
+# When a cluster is opened, its frames and those of this many following
+# clusters are rendered in the background (0: only the opened cluster,
+# -1: no prefetching)
+PREFETCH_CLUSTERS = int(os.environ.get("PREFETCH_CLUSTERS", 2))
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 2))
+
+# Threads that decode and render full frames, max number of frame requests
+# waiting for them (503 above this), and threads that OpenCV may use internally
+FRAME_WORKERS = int(os.environ.get("FRAME_WORKERS", 4))
+FRAME_QUEUE_MAX = int(os.environ.get("FRAME_QUEUE_MAX", 32))
+OPENCV_THREADS = int(os.environ.get("OPENCV_THREADS", 2))
+
 # TODO: move these to config
 DATA_DIR = os.environ["DATA_DIR"].rstrip("/")
 FILMS_DIR = os.environ["FILMS_DIR"].rstrip("/")
 METADATA_DIR = os.environ["METADATA_DIR"].rstrip("/")
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "video-labeler"
+))
 
-def parse_actor_age(row):
-    """Parse actor age at the year when a movie was released.
+def make_private_dir(path: str):
+    """Create a directory that only this user can access, or check that an
+    existing one belongs to this user. Caches are trusted when they are read.
     """
-    birthday_str = row["birthday"]
-    movie_year = row["movie_year"]
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.stat(path).st_uid != os.getuid():
+        raise RuntimeError(f"{path} belongs to another user, set CACHE_DIR to a directory of this user.")
+
+make_private_dir(CACHE_DIR)
+
+# Number of backend processes (uvicorn --workers) that each run this module.
+# Movie data is parsed once, and shared by them as memory-mapped snapshots.
+WEB_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# Movie data is loaded at startup by this many processes ("eager"), or when a
+# movie is first used ("lazy")
+DATA_LOADING = os.environ.get("DATA_LOADING", "eager")
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+
+# Optionally, saves are acknowledged once they are in a local journal, and
+# written to the database in the background every WRITE_BEHIND_INTERVAL seconds
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 1.0))
+
+# With several workers, /metrics adds up the metrics that each worker writes
+# under CACHE_DIR
+shared_metrics = SharedMetrics(REGISTRY, os.path.join(CACHE_DIR, "metrics")) if WEB_WORKERS > 1 else None
+
+# Requests are profiled when they have PROFILE_TOKEN in their X-Profile-Token
+# header, for a PROFILE_SAMPLE_RATE fraction of all requests, and when they take
+# longer than PROFILE_SLOW_MS (0: off). The newest PROFILE_MAX_FILES profiles are
+# kept under CACHE_DIR.
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN") or None
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0.0))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 200))
+
+# Time between stack samples of profiled requests, in seconds
+PROFILE_INTERVAL = 0.01
+
+profiler = Profiler(
+    os.path.join(CACHE_DIR, "profiles"),
+    routes=lambda: app.routes,
+    token=PROFILE_TOKEN,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    slow_ms=PROFILE_SLOW_MS,
+    interval=PROFILE_INTERVAL,
+    max_profiles=PROFILE_MAX_FILES,
+)
+app.add_middleware(ProfilerMiddleware, profiler=profiler)
 
-    if type(birthday_str) != str or type(movie_year) != int:
-        return None
+STARTUP_SECONDS = REGISTRY.gauge(
+    "startup_phase_duration_seconds", "Time of the steps of starting the backend.", ("phase",)
+)
+FRAME_REQUESTS = REGISTRY.counter(
+    "frame_requests_total", "Full frames by where they came from: memory (served directly), cache (memory or disk, in the frame executor) or render.", ("source",)
+)
 
-    year = 0
-    if len(birthday_str) == 10 or len(birthday_str) == 4:
-        birthday_str = birthday_str[-4:]
+write_behind_client = None
+if WRITE_BEHIND:
+    db_client = write_behind_client = WriteBehindClient(
+        db_client, os.path.join(CACHE_DIR, "journal"), flush_interval=WRITE_BEHIND_INTERVAL
+    )
+    signal.signal(signal.SIGINT, db_client.close)
+    signal.signal(signal.SIGTERM, db_client.close)
+
+# Label counts (movie list, actor list) are cached for this many seconds,
+# or until a label of the movie is saved (0: no caching)
+COUNT_CACHE_TTL = float(os.environ.get("COUNT_CACHE_TTL", 5.0))
+db_client = CachedCountsClient(db_client, ttl=COUNT_CACHE_TTL)
+
+# Frames are processed in parallel by our own threads, so keep OpenCV's
+# internal thread pools from oversubscribing the CPU
+cv2.setNumThreads(OPENCV_THREADS)
+
+def parse_actor_ages(birthdays: pd.Series, movie_years: pd.Series):
+    """Parse actor ages at the years when movies were released. Returns a float
+    Series, with NaN when the age is unknown.
+    """
+    # Only string birthdays and integer years are parsed (a year column with
+    # missing values is float, so then no ages are known)
+    if pd.api.types.is_integer_dtype(movie_years):
+        known = pd.Series(True, index=movie_years.index)
+    else:
+        known = movie_years.map(lambda y: type(y) == int).astype(bool)
+    known &= birthdays.map(lambda b: type(b) == str).astype(bool)
+
+    # Birthdays are like 1920-01-01 or 1920, anything else counts as year 0
+    birthdays = birthdays[known].astype(object)
+    is_year = birthdays.str.len().isin([4, 10])
+    tails = birthdays[is_year].str[-4:]
+    years = pd.Series(0, index=birthdays.index, dtype=np.int64)
+
+    def parse_year(year_str):
         try:
-            year = int(birthday_str)
+            return int(year_str)
         except:
-            pass
-    else:
-        birthday_str == birthday_str.strip(".0")
-        if len(birthday_str) == 4:
-            try:
-                year = int(birthday_str)
-            except:
-                pass
-
-    age = movie_year - year
-    if age >= 0 and age < 150:
-        return age
-    else:
-        return None
+            return 0
+    # Few distinct years, so parse each only once
+    unique_years = {tail: parse_year(tail) for tail in tails.unique()}
+    years[is_year] = tails.map(unique_years).astype(np.int64)
+
+    ages = movie_years[known].astype(np.int64) - years
+    ages = ages[(ages >= 0) & (ages < 150)]
+    return ages.astype(float).reindex(movie_years.index)
 
 def read_metadata(metadata_dir):
     # actors.csv contains data about movies, and which actors where in them.
@@ -102,17 +229,19 @@ def read_metadata(metadata_dir):
     actors_df = df.drop(columns=["movie_name", "birthplace"])
     # In some movies, the same actor has multiple roles (rare, but possible)
     # Put those cases into the same row in the actor_df
-    duplicated = actors_df.duplicated(subset=["movie_id", "id"])
-    for row in actors_df[duplicated].itertuples():
-        selected_rows = (actors_df.movie_id == row.movie_id) & (actors_df.id == row.id)
-        sub_df = actors_df[selected_rows]
-        combined_role = ", ".join(filter(lambda r: r, set(sub_df.role.tolist())))
-        actors_df.loc[sub_df.index, "role"] = combined_role
-    actors_df = actors_df[~duplicated]
+    keys = ["movie_id", "id"]
+    duplicated = actors_df.duplicated(subset=keys)
+    multiple_roles = actors_df.duplicated(subset=keys, keep=False)
+    combined_roles = actors_df[multiple_roles].groupby(keys, sort=False, dropna=False).role.agg(
+        lambda roles: ", ".join(r for r in dict.fromkeys(roles) if type(r) == str and r)
+    )
+    actors_df = actors_df[~duplicated].copy()
+    rows = actors_df[multiple_roles[~duplicated]]
+    actors_df.loc[rows.index, "role"] = combined_roles.loc[list(zip(rows.movie_id, rows.id))].values
     actors_df["id"] = actors_df["id"].astype(str)
 
     # Finalize actors dataframe and set index [movie_id, actor_id]
-    actors_df["age"] = actors_df.apply(parse_actor_age, axis=1)
+    actors_df["age"] = parse_actor_ages(actors_df.birthday, actors_df.movie_year)
     actors_df = actors_df.drop(columns=["birthday", "movie_year"])
     actors_df = actors_df.set_index(["movie_id", "id"])
     actors_df["id"] = actors_df.index.get_level_values("id")
@@ -131,12 +260,57 @@ def read_metadata(metadata_dir):
 
     return movie_df, actors_df, actor_images_df, aspects_df
 
-def img_tag(movie_id: int, frame: int, box: List[int]):
-    """Get a 'standard' image tag as used by the face recognition stack.
+# Bump when read_metadata changes, to invalidate cached metadata
+METADATA_CACHE_VERSION = 1
+
+def load_metadata(metadata_dir: str, cache_dir: str):
+    """Same as read_metadata, but cached in cache_dir until one of the CSV
+    files changes.
     """
-    # Real example of full file name: 121614:3616:235_183_293_262.jpeg
-    # Face file names are <tag>.jpeg
-    return f"{movie_id}:{frame}" + ":{}_{}_{}_{}".format(*box)
+    sources = [os.path.join(metadata_dir, name) for name in ("actors.csv", "actor_images.csv", "aspect_ratios.csv")]
+    key = {
+        "version": METADATA_CACHE_VERSION,
+        "sources": source_stamps(sources),
+        "pandas": pd.__version__,
+    }
+    cache_path = os.path.join(cache_dir, "metadata.npz")
+    metadata = load_dataframes(cache_path, key)
+    if metadata is not None:
+        return tuple(metadata)
+
+    metadata = read_metadata(metadata_dir)
+    try:
+        save_dataframes(cache_path, metadata, key)
+    except (OSError, TypeError):
+        print("Could not cache metadata.")
+    return metadata
+
+def build_actor_index(actors_df, actor_images_df):
+    """Precompute the static part of /api/actors for every movie. Returns a
+    dict: movie_id -> list of actors, each with their images ordered so that
+    images from that movie come first. Label counts are added per request.
+    """
+    # actor_id -> list of (movie_id, filename), by n_detections
+    actor_images = {}
+    for actor_id, sub_df in actor_images_df.groupby(level="actor_id", sort=False):
+        sub_df = sub_df.sort_values("n_detections")
+        actor_images[actor_id] = list(zip(sub_df.movie_id.tolist(), sub_df.filename.tolist()))
+
+    actor_index = {}
+    for actor in actors_df.itertuples():
+        movie_id = int(actor.Index[0])
+        images = actor_images.get(actor.id, [])
+        # Add images from the correct movie first.
+        image_names = [name for m, name in images if m == movie_id]
+        image_names += [name for m, name in images if m != movie_id]
+        actor_index.setdefault(movie_id, []).append({
+            "id": actor.id,
+            "name": actor.name,
+            "role": actor.role,
+            "age": None if pd.isna(actor.age) else int(actor.age),
+            "images": [f"images/actors/{name}" for name in image_names],
+        })
+    return actor_index
 
 def parse_tag(tag: str):
     """Parse 'standard' image tag and return Tuple[int, int, int, int, int]
@@ -162,100 +336,18 @@ def parse_user(request: Request):
 
     return username
 
-def split_evenly(items, split_n: int):
-    """Select evenly distributed split-n items from a list.
+def read_datadirs(data_dir):
+    """Find movies in data_dir, and load their data. Data is loaded in parallel
+    at startup, or on first use of each movie if DATA_LOADING is lazy.
     """
-    n = len(items)
-    if split_n >= n:
-        return items
-    step = n // (split_n - 1)
-    return [items[min(n - 1, m)] for m in range(0, n + step - 1, step)][:split_n]
+    lazy = DATA_LOADING == "lazy"
+    summaries = read_summaries(
+        data_dir, FILMS_DIR, CACHE_DIR, ITEMS_PER_TRAJECTORY, parse=not lazy, n_workers=LOAD_WORKERS
+    )
 
-def read_datadirs(data_dir):
-    # Expand potential globs
-    # data_dir contains folders like 12345-data for each movie
-    dirs = glob.glob(f"{data_dir}/*-data")
-
-    # Map movie ids to movie paths
-    movie_path_map = {}
-    _, _, movie_files = next(os.walk(FILMS_DIR))
-    for name in sorted(movie_files):
-        try:
-            movie_id = int(name.split("-")[0])
-            movie_path_map[movie_id] = os.path.join(FILMS_DIR, name)
-        except:
-            pass
-
-    # Map id to directory data
-    dir_data = {}
-    for dir in dirs:
-        movie_id = int(os.path.basename(dir).split("-")[0])
-        trajectories_file = os.path.join(dir, "trajectories.jsonl")
-        clusters_file = os.path.join(dir, "clusters.json")
-        predictions_file = os.path.join(dir, "predictions.json")
-        images_dir = os.path.join(dir, "images")
-
-        _, _, images = next(os.walk(images_dir))
-        images_set = set(images)
-
-        # Read all trajectories for this movie
-        with open(trajectories_file, "r") as f:
-            trajectories = [json.loads(line) for line in f]
-            # Filter trajectories to have only boxes that have an image.
-            for t in trajectories:
-                valid_boxes = []
-                for frame, box in enumerate(t["bbs"], start=t["start"]):
-                    file_name = f"{img_tag(movie_id, frame, box)}.jpeg"
-                    if file_name in images_set:
-                        valid_boxes.append((frame, box))
-                t["image_bbs"] = valid_boxes
-
-        # Read clusters corresponing to each trajectory
-        with open(clusters_file, "r") as f:
-            cluster_indices = json.load(f)["clusters"]
-            assert len(cluster_indices) == len(trajectories), "All trajectories need a cluster!"
-
-        # Compute better image lookup table for clusters
-        # Note: trajectories are implicitly indexed by their order in the list
-        # Cluster indices are assumed to be dense, from zero
-        clusters = {}
-        trajectory_map = {}
-        for ti, ci in enumerate(cluster_indices):
-            if ci not in clusters:
-                clusters[ci] = {
-                    "image_data": [],
-                    "n_trajectories": 0,
-                    "n_shown_images": 0,  # N images that will be send to the frontend
-                    "n_total_images": 0,  # Total images in related trajectories
-                }
-            trajectory = trajectories[ti]
-            assert trajectory["index"] == ti, "Trajectory implicit index wrong?"
-            # TODO: smarter selection of images to show?
-            image_bbs = split_evenly(trajectory["image_bbs"], ITEMS_PER_TRAJECTORY)
-            # Tuples in the list are: (trajectory_id, frame_index, bounding_box)
-            clusters[ci]["image_data"] += [(ti, *ib) for ib in image_bbs]
-            clusters[ci]["n_shown_images"] = len(clusters[ci]["image_data"])
-            clusters[ci]["n_total_images"] += len(trajectory["image_bbs"])
-            clusters[ci]["n_trajectories"] += 1
-
-            # Uniquely map (frame, *box) -> trajectory id for every shown image
-            trajectory_map.update({tuple([frame, *box]): ti for frame, box in image_bbs})
-
-        # Read per-cluster predictions
-        with open(predictions_file, "r") as f:
-            predictions = json.load(f)["predictions"]
-            # Convert keys to integers (JSON only has string keys)
-            predictions = {
-                int(cluster_id): {actor_id: p for actor_id, p in cluster_preds.items()}
-                for cluster_id, cluster_preds in predictions.items()
-            }
-            assert len(predictions) == len(clusters), "Predictions not equal to clusters!"
-
-        if movie_id in movie_path_map:
-            movie_path = movie_path_map[movie_id]
-            # Read movie fps from file so that frontend can compute hh:mm:ss for frames!
-            cap = cv2.VideoCapture(movie_path)
-            fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    for movie_id, summary in summaries.items():
+        movie_path = summary["movie_path"]
+        if movie_path is not None:
             # Read display aspect ratio-adjusted frame resolution
             basename = os.path.basename(movie_path)
             width = int(aspects_df.at[basename, "display_width"])
@@ -264,53 +356,99 @@ def read_datadirs(data_dir):
             # Compute a scaling factor, that is used to scale frames down when sending
             # to the frontend
             scaling_factor = min(1.0, FRAME_MAX_RES / max(width, height))
-            cap.release()
         else:
-            fps = 25.0
             scaling_factor = 1.0
             resolution = (0, 0)
-            movie_path = None
             print(f"Movie file not found for: {movie_id}")
 
-        data = {
-            "id": movie_id,
-            "path": dir,
-            "movie_path": movie_path,
-            "clusters": clusters,
-            "n_clusters": len(clusters),
-            "predictions": predictions,
-            "trajectory_map": trajectory_map,
-            "fps": fps,
-            "resolution": resolution,
-            "scaling_factor": scaling_factor,
-        }
-        dir_data[movie_id] = data
+        summary["resolution"] = resolution
+        summary["scaling_factor"] = scaling_factor
+
+    def load(summary):
+        return read_datadir(
+            summary["path"], summary["id"], summary["movie_path"], CACHE_DIR, ITEMS_PER_TRAJECTORY
+        )
+
+    dir_data = MovieRegistry(summaries, load)
+    if not lazy:
+        # Snapshots were (re)built by the summary workers, so this is fast
+        for movie_id in dir_data:
+            dir_data[movie_id]
 
     return dir_data
 
-movie_df, actors_df, actor_images_df, aspects_df = read_metadata(METADATA_DIR)
-dir_data = read_datadirs(DATA_DIR)
+with STARTUP_SECONDS.time(phase="load_metadata"):
+    movie_df, actors_df, actor_images_df, aspects_df = load_metadata(METADATA_DIR, CACHE_DIR)
+with STARTUP_SECONDS.time(phase="build_actor_index"):
+    actor_index = build_actor_index(actors_df, actor_images_df)
+with STARTUP_SECONDS.time(phase="read_datadirs"):
+    dir_data = read_datadirs(DATA_DIR)
+
+# Background threads start only now, since reading the movies above forks
+# worker processes, which is not safe with other threads running
+profiler.start_thread()
+if shared_metrics is not None:
+    shared_metrics.start_thread()
+if write_behind_client is not None:
+    write_behind_client.start_thread()
+
+# Keyframe positions let decoders skip seeks within a GOP. Built in the
+# background, since probing all films can take a while.
+keyframe_index = KeyframeIndex()
+keyframe_index.build_in_background(dir_data.summaries)
+
+# Open video decoders are reused between frame requests
+video_pool = VideoPool(
+    max_open=VIDEO_POOL_SIZE,
+    max_per_movie=VIDEO_POOL_PER_MOVIE,
+    decode_threads=OPENCV_THREADS,
+    keyframe_index=keyframe_index,
+)
+
+frame_executor = FrameExecutor(n_workers=FRAME_WORKERS, max_queued=FRAME_QUEUE_MAX)
+
+frame_cache = FrameCache(
+    memory_bytes=FRAME_CACHE_MEMORY_MB * 2**20,
+    disk_dir=os.path.join(CACHE_DIR, "frames"),
+    disk_bytes=FRAME_CACHE_DISK_MB * 2**20,
+)
+
+REGISTRY.gauge(
+    "frame_tasks_pending", "Frame requests queued or running in the frame executor.",
+    function=lambda: frame_executor.n_pending,
+)
+REGISTRY.gauge(
+    "frame_cache_bytes", "Size of cached frames.", ("tier",),
+    function=lambda: {
+        ("memory",): frame_cache.memory.n_bytes,
+        **({("disk",): frame_cache.disk.n_bytes} if frame_cache.disk else {}),
+    },
+)
 
 # Filter movies to those that have data
 movie_df = movie_df.loc[dir_data.keys()]
 movie_df["year"] = movie_df.year.astype(int)
-movie_df["n_clusters"] = movie_df.index.map(lambda movie_id: dir_data[movie_id]["n_clusters"])
-movie_df["fps"] = movie_df.index.map(lambda movie_id: dir_data[movie_id]["fps"])
+movie_df["n_clusters"] = movie_df.index.map(lambda movie_id: dir_data.summary(movie_id)["n_clusters"])
+movie_df["fps"] = movie_df.index.map(lambda movie_id: dir_data.summary(movie_id)["fps"])
+
+# Movie data that doesn't change, movie_id -> dict
+movie_index = {
+    int(movie.id): {
+        "id": int(movie.id),
+        "name": movie.name,
+        "year": int(movie.year),
+        "n_clusters": int(movie.n_clusters),
+        "fps": movie.fps,
+    } for movie in movie_df.itertuples(index=False)
+}
 
 def get_movie_data(movie_ids: List[int], movie_counts):
     """Utility method to get movie data in a JSON-digestible format.
     """
-    if not all(id in movie_df.index for id in movie_ids):
+    if not all(id in movie_index for id in movie_ids):
         return None
 
-    return [{
-        "id": int(movie_df.at[id, "id"]),
-        "name": movie_df.at[id, "name"],
-        "year": int(movie_df.at[id, "year"]),
-        "n_clusters": int(movie_df.at[id, "n_clusters"]),
-        "n_labeled_clusters": movie_counts[id],
-        "fps": movie_df.at[id, "fps"],
-    } for id in movie_ids]
+    return [{**movie_index[id], "n_labeled_clusters": movie_counts[id]} for id in movie_ids]
 
 @app.get("/api/movies/{movie_id}")
 def get_movie(movie_id: int, response: Response):
@@ -343,75 +481,126 @@ def list_movies(response: Response):
             "code": "LABEL_COUNT_READ",
         }
 
-    all_movie_ids = movie_df.id.tolist()
+    all_movie_ids = list(movie_index)
     movie_data = get_movie_data(all_movie_ids, movie_counts)
 
     return movie_data
 
 @app.get("/api/actors/{movie_id}")
-def list_actors(movie_id: int):
+def list_actors(movie_id: int, response: Response):
+    if movie_id not in actor_index:
+        raise HTTPException(404, detail=f"No actors for movie {movie_id}.")
+
     # Get the number of current images labeled, global and movie level
     global_count, movie_count = db_client.get_actor_counts(movie_id)
+    if global_count is None or movie_count is None:
+        response.status_code = 500
+        return {
+            "error": "Could not read actor label counts from database.",
+            "code": "LABEL_COUNT_READ",
+        }
 
-    df = actors_df.loc[movie_id]
-    actors = []
-    for actor in df.itertuples():
-        image_names = []
-        if actor.id in actor_images_df.index:
-            sub_df = actor_images_df.loc[[actor.id]].sort_values("n_detections")
-            same_movie = (sub_df.movie_id == movie_id)
-            # Add images from the correct movie first.
-            image_names += sub_df[same_movie].filename.tolist()
-            image_names += sub_df[~same_movie].filename.tolist()
-        actors.append({
-            "id": actor.id,
-            "name": actor.name,
-            "role": actor.role,
-            "age": None if pd.isna(actor.age) else int(actor.age),
-            "images": [f"images/actors/{name}" for name in image_names],
-            "movie_count": movie_count[actor.id],
-            "global_count": global_count[actor.id],
-        })
-    return actors
-
-@app.get("/images/frames/{movie_id}/{frame_index}_{box}.jpeg")
-def get_frame(movie_id: int, frame_index: int, box: str):
-    if not movie_id in dir_data:
-        raise HTTPException(404, error=f"No such movie {movie_id}.")
-
-    if dir_data[movie_id]["movie_path"] is None:
-        # This happens if the FILMS_DIR environment variable was improperly set,
-        # or if no movie file (eg. mp4, etc.) was found in FILMS_DIR for this film.
-        raise HTTPException(500, error=f"No frame data for film.")
-
-    cap = cv2.VideoCapture(dir_data[movie_id]["movie_path"])
+    return [{
+        **actor,
+        "movie_count": movie_count[actor["id"]],
+        "global_count": global_count[actor["id"]],
+    } for actor in actor_index[movie_id]]
+
+@app.get("/api/stats/cache")
+def get_cache_stats():
+    """Hits and misses of the label count caches, in this backend process.
+    """
+    return db_client.stats()
 
-    if not cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index):
-        raise HTTPException(400, error="Bad request!")
+@app.get("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format, of all backend workers.
+    """
+    snapshot = shared_metrics.collect() if shared_metrics else REGISTRY.snapshot()
+    return Response(render(snapshot), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-    box_split = box.split("-")
-    try:
-        box_split = [int(c) for c in box_split]
-    except:
-        raise HTTPException(400, error="Bad request!")
+def check_profile_token(request: Request):
+    if not profiler.is_admin(request.headers.get("x-profile-token")):
+        raise HTTPException(403, detail="Profiles need the PROFILE_TOKEN in the X-Profile-Token header.")
 
-    if len(box_split) != 4:
-        raise HTTPException(400, error="Bad request!")
+@app.get("/api/profiles")
+def list_profiles(request: Request):
+    """Profiling settings, and the saved request profiles, newest first.
+    """
+    check_profile_token(request)
+    return {**profiler.settings(), "profiles": profiler.list()}
 
-    ret, frame = cap.read()
-    cap.release()
+@app.put("/api/profiles/settings")
+def set_profile_settings(settings: ProfileSettings, request: Request):
+    """Change the profiled fraction of requests and the slow request threshold,
+    for all workers.
+    """
+    check_profile_token(request)
+    profiler.set_settings(settings.sample_rate, settings.slow_ms)
+    return profiler.settings()
+
+@app.get("/api/profiles/{name}")
+def get_profile(name: str, request: Request, format: str = "json"):
+    """A saved profile, with its database calls and stack samples, or only its
+    stacks in the collapsed format for flame graphs with format=folded.
+    """
+    check_profile_token(request)
+    profile = profiler.read(name)
+    if profile is None:
+        raise HTTPException(404, detail=f"No such profile {name}.")
+    if format == "folded":
+        return Response(folded(profile), media_type="text/plain")
+    return profile
+
+# movie_id -> (film_stamp of the movie, monotonic time when it was checked)
+film_stamps = {}
+
+def cached_film_stamp(movie_id: int):
+    """film_stamp of a movie if it was checked in the last FILM_STAT_SECONDS,
+    otherwise None.
+    """
+    cached = film_stamps.get(movie_id)
+    if cached is not None and time.monotonic() - cached[1] < FILM_STAT_SECONDS:
+        return cached[0]
+    return None
 
-    if not ret:
-        raise HTTPException(500, error="Error reading movie.")
+def film_stamp(movie_id: int):
+    """Name, size and modification time of the film of a movie.
+    """
+    film = cached_film_stamp(movie_id)
+    if film is None:
+        movie_path = dir_data.summary(movie_id)["movie_path"]
+        stat = os.stat(movie_path)
+        film = f"{os.path.basename(movie_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        film_stamps[movie_id] = (film, time.monotonic())
+    return film
+
+def frame_digest(movie_id: int, frame_index: int, box: List[int], film: str):
+    """Digest of everything that determines the bytes of a rendered frame:
+    the film file (film_stamp), the frame and box, and the scaling and
+    encoding.
+    """
+    summary = dir_data.summary(movie_id)
+    w, h = summary["resolution"]
+    box_str = "_".join(map(str, box))
+    key = (
+        f"{film}:{frame_index}:{box_str}:{w}x{h}:{summary['scaling_factor']}:"
+        f"{FRAME_MAX_RES}:{FRAME_JPEG_QUALITY}"
+    )
+    return FrameCache.digest(key)
 
-    w, h = dir_data[movie_id]["resolution"]
-    scale = dir_data[movie_id]["scaling_factor"]
+def render_frame(movie_id: int, frame, box: List[int]):
+    """Scale a decoded frame, draw the bounding box on it and encode as jpeg.
+    """
+    w, h = dir_data.summary(movie_id)["resolution"]
+    scale = dir_data.summary(movie_id)["scaling_factor"]
     scaled_w = round(scale * w)
     scaled_h = round(scale * h)
-    box = [round(c * scale) for c in box_split]
+    box = [round(c * scale) for c in box]
 
     # Scale frame if needed to correct size
-    frame = cv2.resize(frame, (scaled_w, scaled_h), interpolation=cv2.INTER_AREA)
+    with FRAME_PHASE_SECONDS.time(phase="resize"):
+        frame = cv2.resize(frame, (scaled_w, scaled_h), interpolation=cv2.INTER_AREA)
 
     # Draw bounding box on frame to highlight actor (color is BGR)
     color = (255, 255, 255)
@@ -419,10 +608,119 @@ def get_frame(movie_id: int, frame_index: int, box: str):
     frame = cv2.rectangle(frame, tuple(box[:2]), tuple(box[2:]), color, thickness)
 
     # Encode into jpeg in-memory
-    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 75]
-    result, encimg = cv2.imencode(".jpg", frame, encode_param)
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), FRAME_JPEG_QUALITY]
+    with FRAME_PHASE_SECONDS.time(phase="encode"):
+        result, encimg = cv2.imencode(".jpg", frame, encode_param)
+    return encimg.tobytes()
+
+def warm_cluster_frames(movie_id: int, cluster_id: int, cancelled):
+    """Render all full frames of a cluster into the frame cache, decoding
+    frames in one pass through the movie.
+    """
+    movie_path = dir_data.summary(movie_id)["movie_path"]
+    if movie_path is None:
+        return
+
+    # frame_index -> list of (box, digest) that are not cached yet
+    missing = defaultdict(list)
+    film = film_stamp(movie_id)
+    for _, frame_index, box in dir_data[movie_id]["clusters"][cluster_id]["image_data"]:
+        digest = frame_digest(movie_id, frame_index, box, film)
+        if not frame_cache.contains(digest):
+            missing[frame_index].append((box, digest))
+
+    if not missing:
+        return
+
+    with video_pool.reader(movie_id, movie_path, min(missing)) as reader:
+        for frame_index, frame in reader.iter_frames(list(missing)):
+            if cancelled():
+                return
+            if frame is None:
+                continue
+            for box, digest in missing[frame_index]:
+                frame_cache.put(digest, render_frame(movie_id, frame, box))
+
+prefetcher = FramePrefetcher(
+    warm_cluster_frames, n_ahead=PREFETCH_CLUSTERS, n_workers=PREFETCH_WORKERS
+)
+REGISTRY.gauge(
+    "prefetch_clusters_pending", "Clusters scheduled for prefetching.", function=lambda: prefetcher.n_pending
+)
 
-    return StreamingResponse(io.BytesIO(encimg.tobytes()), media_type="image/jpeg")
+@profiled
+def load_frame(movie_id: int, frame_index: int, box: List[int], digest: str):
+    """Get a rendered frame from the frame cache, or decode and render it.
+    Blocking, so this runs in the frame executor.
+    """
+    content = frame_cache.get(digest)
+    if content is not None:
+        FRAME_REQUESTS.inc(source="cache")
+        return content
+
+    FRAME_REQUESTS.inc(source="render")
+    movie_path = dir_data.summary(movie_id)["movie_path"]
+    with video_pool.reader(movie_id, movie_path, frame_index) as reader:
+        # Frame count can be unknown (0) for some containers
+        in_range = frame_index >= 0 and (reader.n_frames <= 0 or frame_index < reader.n_frames)
+        frame = reader.read(frame_index) if in_range else None
+
+    if not in_range:
+        raise HTTPException(400, detail="Bad request!")
+
+    if frame is None:
+        raise HTTPException(500, detail="Error reading movie.")
+
+    content = render_frame(movie_id, frame, box)
+    frame_cache.put(digest, content)
+    return content
+
+@app.get("/images/frames/{movie_id}/{frame_index}_{box}.jpeg")
+async def get_frame(movie_id: int, frame_index: int, box: str, request: Request):
+    if not movie_id in dir_data:
+        raise HTTPException(404, detail=f"No such movie {movie_id}.")
+
+    if dir_data.summary(movie_id)["movie_path"] is None:
+        # This happens if the FILMS_DIR environment variable was improperly set,
+        # or if no movie file (eg. mp4, etc.) was found in FILMS_DIR for this film.
+        raise HTTPException(500, detail=f"No frame data for film.")
+
+    box_split = box.split("-")
+    try:
+        box_split = [int(c) for c in box_split]
+    except:
+        raise HTTPException(400, detail="Bad request!")
+
+    if len(box_split) != 4 or frame_index < 0:
+        raise HTTPException(400, detail="Bad request!")
+
+    film = cached_film_stamp(movie_id)
+    if film is None:
+        # Off the event loop, the film may be on slow storage
+        film = await asyncio.to_thread(film_stamp, movie_id)
+
+    # Rendered frames never change, so the ETag is known before rendering
+    digest = frame_digest(movie_id, frame_index, box_split, film)
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "max-age=3600"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    # Frames in memory are served directly, everything else goes to the pool
+    content = frame_cache.memory.get(digest)
+    if content is not None:
+        FRAME_REQUESTS.inc(source="memory")
+    else:
+        result = frame_executor.submit(load_frame, movie_id, frame_index, box_split, digest)
+        if result is None:
+            # Too much work queued already, tell the browser to retry
+            raise HTTPException(
+                503, detail="Too many frame requests.", headers={"Retry-After": "1"}
+            )
+        content = await result
+
+    return Response(content, media_type="image/jpeg", headers=headers)
 
 @app.get("/images/actors/{filename}")
 def get_image(filename: str):
@@ -441,15 +739,46 @@ def get_image(filename: str):
         headers={"Cache-Control": "max-age=3600"}
     )
 
+# Packed face images of movies (see image_pack.py), opened when first used.
+# movie_id -> ImagePack
+image_packs = {}
+image_packs_lock = threading.Lock()
+
+def get_image_pack(movie_id: int):
+    """Pack of a movie, or None if it has none. Movies can be packed while the
+    backend runs, so a missing pack is looked for again on every call.
+    """
+    image_pack = image_packs.get(movie_id)
+    if image_pack is not None:
+        return image_pack
+    movie_dir = dir_data.summary(movie_id)["path"]
+    if not has_pack(movie_dir):
+        return None
+    with image_packs_lock:
+        if movie_id not in image_packs:
+            image_packs[movie_id] = ImagePack(movie_dir)
+        return image_packs[movie_id]
+
 @app.get("/images/{movie_id}:{frame}:{bbox_str}.jpeg")
 def get_image(movie_id: int, frame: int, bbox_str: str):
     if movie_id not in movie_df.index:
         raise HTTPException(404, error=f"Invalid movie id {movie_id}.")
 
     bbox = [int(c) for c in bbox_str.replace("/", "").split("_")]
-    tag = img_tag(movie_id, frame, bbox)
 
-    movie_dir = dir_data[movie_id]["path"]
+    image_pack = get_image_pack(movie_id)
+    if image_pack is not None:
+        content = image_pack.get(frame, bbox)
+        if content is None:
+            raise HTTPException(404, detail="File not found.")
+        return Response(
+            content,
+            media_type="image/jpeg",
+            headers={"Cache-Control": "max-age=3600"}
+        )
+
+    tag = img_tag(movie_id, frame, bbox)
+    movie_dir = dir_data.summary(movie_id)["path"]
     file_path = os.path.join(movie_dir, "images", f"{tag}.jpeg")
 
     if not os.path.exists(file_path):
@@ -470,12 +799,19 @@ def get_cluster_data(movie_id: int, cluster_id: int, request: Request, response:
 
     movie_data = dir_data[movie_id]
     data_cluster_id = cluster_id
+    if data_cluster_id not in movie_data["clusters"]:
+        raise HTTPException(404, detail=f"Invalid cluster id {cluster_id}.")
+    cluster = movie_data["clusters"][data_cluster_id]
 
     # Default statuses for clusters and images if the database didn't have records
     DEFAULT_IMAGE_STATUS = "same"
     DEFAULT_CLUSTER_STATUS = "labeled"
 
     username = parse_user(request)
+
+    # Start rendering full frames before the annotator clicks on them
+    prefetcher.schedule(username, movie_id, data_cluster_id, movie_data["n_clusters"])
+
     annotation = db_client.get_annotations(username, movie_id, data_cluster_id)
 
     if annotation is None:
@@ -493,7 +829,6 @@ def get_cluster_data(movie_id: int, cluster_id: int, request: Request, response:
     status = annotation.get("status", DEFAULT_CLUSTER_STATUS)
 
     # Collect static data for each image
-    cluster = movie_data["clusters"][data_cluster_id]
     images = []
     for _, frame, box in cluster["image_data"]:
         tag = img_tag(movie_id, frame, box)
@@ -520,6 +855,63 @@ def get_cluster_data(movie_id: int, cluster_id: int, request: Request, response:
         "predicted_actors": predicted_actors,
     }
 
+def read_face_image(movie_id: int, frame: int, box: List[int]):
+    """Bytes of a face image, from the pack of the movie or from its file.
+    None if there is no such image.
+    """
+    image_pack = get_image_pack(movie_id)
+    if image_pack is not None:
+        return image_pack.get(frame, box)
+
+    movie_dir = dir_data.summary(movie_id)["path"]
+    file_path = os.path.join(movie_dir, "images", f"{img_tag(movie_id, frame, box)}.jpeg")
+    try:
+        with open(file_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+@app.get("/api/faces/clusters/{movie_id}/{cluster_id}/images")
+def get_cluster_images(movie_id: int, cluster_id: int, request: Request):
+    """All face images of a cluster in one response, in the same order as the
+    images of get_cluster_data. Each image is a 4-byte big-endian length
+    followed by the jpeg, and missing images have length 0.
+    """
+    if movie_id not in movie_df.index:
+        raise HTTPException(404, detail=f"Invalid movie id {movie_id}.")
+
+    movie_data = dir_data[movie_id]
+    if cluster_id not in movie_data["clusters"]:
+        raise HTTPException(404, detail=f"Invalid cluster id {cluster_id}.")
+    image_data = movie_data["clusters"][cluster_id]["image_data"]
+
+    # The images of a cluster only change when its image data does
+    etag = f'"{FrameCache.digest(f"{movie_id}:{cluster_id}:{image_data}")}"'
+    headers = {"ETag": etag, "Cache-Control": "max-age=3600"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    parts = []
+    for _, frame, box in image_data:
+        content = read_face_image(movie_id, frame, box) or b""
+        parts.append(struct.pack(">I", len(content)))
+        parts.append(content)
+
+    return Response(b"".join(parts), media_type="application/octet-stream", headers=headers)
+
+def get_image_data_db(movie_data, images):
+    """Images of a cluster as tuples (tag, status, trajectory_id) for the database.
+    """
+    image_data_db = []
+    for image in images:
+        # from images/{tag}.jpeg -> tag
+        tag = image.url[7:-5]
+        frame_and_box = parse_tag(tag)
+        trajectory_id = movie_data["trajectory_map"][frame_and_box]
+        image_data_db.append((tag, image.status, trajectory_id))
+    return image_data_db
+
 @app.post("/api/faces/clusters/{movie_id}/{cluster_id}")
 def set_cluster_data(
     movie_id: int, cluster_id: int, data: ClusterLabels, request: Request, response: Response
@@ -532,13 +924,7 @@ def set_cluster_data(
     movie_data = dir_data[movie_id]
     data_cluster_id = cluster_id
 
-    image_data_db = []
-    for image in data.images:
-        # from images/{tag}.jpeg -> tag
-        tag = image.url[7:-5]
-        frame_and_box = parse_tag(tag)
-        trajectory_id = movie_data["trajectory_map"][frame_and_box]
-        image_data_db.append((tag, image.status, trajectory_id))
+    image_data_db = get_image_data_db(movie_data, data.images)
 
     username = parse_user(request)
     success = db_client.insert_annotations(
@@ -555,6 +941,46 @@ def set_cluster_data(
             "code": "DATABASE_WRITE_ERROR",
         }
 
+@app.post("/api/faces/clusters/{movie_id}")
+def set_clusters_data(movie_id: int, data: BatchClusterLabels, request: Request, response: Response):
+    """Save many clusters of a movie at once, in one transaction. Eg. when
+    discarding a run of clusters. Returns a result for each cluster.
+    """
+    if movie_id not in dir_data:
+        raise HTTPException(404, detail=f"Invalid movie id {movie_id}.")
+
+    movie_data = dir_data[movie_id]
+
+    # Clusters with invalid images are skipped, the rest are saved
+    annotations = []
+    results = []
+    for item in data.clusters:
+        if item.cluster_id not in movie_data["clusters"]:
+            results.append({"cluster_id": item.cluster_id, "status": "error", "code": "INVALID_CLUSTER"})
+            continue
+        try:
+            image_data_db = get_image_data_db(movie_data, item.images)
+        except (KeyError, ValueError):
+            results.append({"cluster_id": item.cluster_id, "status": "error", "code": "INVALID_IMAGE"})
+            continue
+        annotations.append((item.cluster_id, item.label, image_data_db, item.status, item.time))
+        results.append({"cluster_id": item.cluster_id, "status": "ok"})
+
+    username = parse_user(request)
+    if annotations and not db_client.insert_annotations_batch(username, movie_id, annotations):
+        # Rare database error occurred, nothing was saved.
+        response.status_code = 500
+        return {
+            "error": "Couldn't save cluster info to database.",
+            "code": "DATABASE_WRITE_ERROR",
+            "results": [
+                {**result, "status": "error", "code": "DATABASE_WRITE_ERROR"} if result["status"] == "ok" else result
+                for result in results
+            ],
+        }
+
+    return {"status": "ok", "results": results}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=5000, log_level="info")
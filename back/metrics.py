@@ -0,0 +1,313 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import os
+import glob
+import json
+import math
+import time
+import tempfile
+import threading
+import traceback
+
+# Metrics in the Prometheus text format, for /metrics. Counters, gauges and
+# histograms are kept per process. With several backend workers, each one
+# writes its metrics to a shared directory, and /metrics adds them up.
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        # Tuple of label values -> value
+        self.values = {}
+
+    def _key(self, labels: Dict[str, str]):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """List of (labels dict, value), where a value is a number, or for
+        histograms a list of [bucket counts, sum].
+        """
+        with self.lock:
+            items = list(self.values.items())
+        return [(dict(zip(self.label_names, key)), value) for key, value in items]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), function: Optional[Callable] = None):
+        super().__init__(name, help, labels)
+        # If set, values are read from function() when collected: a number,
+        # or a dict of label values tuple -> number
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    @contextmanager
+    def time(self, **labels):
+        """Set the gauge to the duration of the block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            values = self.function()
+        except Exception:
+            traceback.print_exc()
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(dict(zip(self.label_names, key)), value) for key, value in values.items()]
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # Counts per bucket (not cumulative), the last one is +Inf
+        i = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts = list(counts)
+            counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _add(self, metric: Metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                # Same metric defined again, e.g. by a second client instance
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels=(), function=None) -> Gauge:
+        gauge = self._add(Gauge(name, help, labels))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """Current values of all metrics, JSON-serializable.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {
+            metric.name: {
+                "type": metric.type,
+                "help": metric.help,
+                "buckets": list(getattr(metric, "buckets", [])),
+                "samples": metric.samples(),
+            } for metric in metrics
+        }
+
+def merge_snapshots(snapshots: Dict[int, dict]):
+    """Add up snapshots of several processes (pid -> snapshot). Gauges are
+    not added up, but get a worker label instead.
+    """
+    merged = {}
+    for pid, snapshot in sorted(snapshots.items()):
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                if metric["type"] == "gauge":
+                    labels = {**labels, "worker": str(pid)}
+                key = tuple(sorted(labels.items()))
+                if key not in target["samples"]:
+                    target["samples"][key] = value
+                elif metric["type"] == "histogram":
+                    counts, total = target["samples"][key]
+                    target["samples"][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                else:
+                    target["samples"][key] += value
+    for metric in merged.values():
+        metric["samples"] = [(dict(key), value) for key, value in metric["samples"].items()]
+    return merged
+
+def _format_labels(labels: Dict[str, str], **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+def _format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(snapshot: dict):
+    """Prometheus text exposition format (version 0.0.4) of a snapshot.
+    """
+    lines: List[str] = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in metric["samples"]:
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + [math.inf], counts):
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(total))}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+class SharedMetrics:
+    """Metrics of all backend workers: each worker writes its snapshot to
+    directory every interval seconds once start_thread() is called, and when
+    collecting. Snapshots of workers that are gone are removed.
+    """
+    def __init__(self, registry: Registry, directory: str, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+
+    def start_thread(self):
+        thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        thread.start()
+
+    def _write(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._write()
+            except OSError:
+                traceback.print_exc()
+
+    def collect(self):
+        self._write()
+        snapshots = {}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            pid = int(os.path.basename(path).split(".")[0])
+            try:
+                if pid != os.getpid():
+                    os.kill(pid, 0)
+                with open(path, "r") as f:
+                    snapshots[pid] = json.load(f)
+            except ProcessLookupError:
+                # Worker exited, its counters go with it
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            except (OSError, ValueError):
+                continue
+        return merge_snapshots(snapshots)
+
+def match_route(routes, scope):
+    """Path pattern of the route that handles a request (ASGI scope).
+    """
+    from starlette.routing import Match
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+class MetricsMiddleware:
+    """ASGI middleware that counts requests in flight and times them, per
+    route (the path pattern, e.g. /api/movies/{movie_id}).
+    """
+    def __init__(self, app, registry: Registry, routes: Callable[[], list]):
+        self.app = app
+        self.routes = routes
+        self.in_flight = registry.gauge(
+            "http_requests_in_flight", "Requests being handled.", ("route",)
+        )
+        self.duration = registry.histogram(
+            "http_request_duration_seconds", "Time to handle requests, until the response is sent.",
+            ("method", "route", "status"),
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route = match_route(self.routes(), scope)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        self.in_flight.inc(route=route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec(route=route)
+            self.duration.observe(
+                time.perf_counter() - start, method=scope["method"], route=route, status=status[0]
+            )
+
+# Metrics of this process
+REGISTRY = Registry()
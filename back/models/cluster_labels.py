@@ -1,14 +1,24 @@
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
 
 class ImageData(BaseModel):
     url: str
-    status: str  # 'same', 'different', 'invalid'
+    status: Literal['same', 'different', 'invalid']
 
 class ClusterLabels(BaseModel):
     """Model for validating post requests that assign labels to clusters and images.
     """
-    label: Optional[str]
+    # Same limits as in the database, so that saves can't be rejected later
+    # when they are written behind
+    label: Optional[str] = Field(None, max_length=64)
     images: List[ImageData]
     time: int
-    status: str  # 'labeled', 'discarded', 'postponed', 'mixed'
+    status: Literal['labeled', 'discarded', 'postponed', 'mixed']
+
+class BatchClusterLabelsItem(ClusterLabels):
+    cluster_id: int
+
+class BatchClusterLabels(BaseModel):
+    """Model for validating post requests that label many clusters of a movie at once.
+    """
+    clusters: List[BatchClusterLabelsItem]
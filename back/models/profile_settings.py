@@ -0,0 +1,7 @@
+from pydantic import BaseModel, Field
+
+class ProfileSettings(BaseModel):
+    """Model for validating requests that change the profiling of requests in all workers.
+    """
+    sample_rate: float = Field(0.0, ge=0.0, le=1.0)
+    slow_ms: float = Field(0.0, ge=0.0)
@@ -0,0 +1,311 @@
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List
+import os
+import glob
+import json
+import re
+import threading
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from cluster_data import Clusters, TrajectoryMap
+from file_lock import file_lock
+from image_pack import INDEX_NAME, has_pack, read_pack_boxes
+from snapshot import source_stamps, load_snapshot, load_snapshot_meta, save_snapshot
+
+def img_tag(movie_id: int, frame: int, box: List[int]):
+    """Get a 'standard' image tag as used by the face recognition stack.
+    """
+    # Real example of full file name: 121614:3616:235_183_293_262.jpeg
+    # Face file names are <tag>.jpeg
+    return f"{movie_id}:{frame}" + ":{}_{}_{}_{}".format(*box)
+
+def split_evenly(counts, split_n: int):
+    """Select evenly distributed split-n items from each of several lists, given
+    the length of each list. Returns an (n_lists, split_n) array of positions
+    in the lists, and a mask of the positions that are selected.
+    """
+    counts = np.asarray(counts, dtype=np.int64)[:, None]
+    k = np.arange(split_n)[None, :]
+    step = counts // max(split_n - 1, 1)
+    # Lists with at most split-n items are selected as a whole
+    split = counts > split_n
+    positions = np.where(split, np.minimum(counts - 1, k * step), k)
+    mask = np.where(split, k * step < counts + step - 1, k < counts)
+    return positions, mask
+
+def read_trajectories(trajectories_file: str):
+    """Read trajectories into columns: first frame of each trajectory, offsets
+    of their boxes, and all boxes as one (n_boxes, 4) array.
+    """
+    starts, lengths, bbs = [], [], []
+    with open(trajectories_file, "r") as f:
+        for ti, line in enumerate(f):
+            t = json.loads(line)
+            assert t["index"] == ti, "Trajectory implicit index wrong?"
+            starts.append(t["start"])
+            lengths.append(len(t["bbs"]))
+            bbs.extend(t["bbs"])
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.array(starts, dtype=np.int64), offsets, np.array(bbs, dtype=np.int64).reshape(-1, 4)
+
+def read_image_boxes(images: List[str], movie_id: int):
+    """Parse face image file names (see img_tag) of a movie into an (n, 5) array
+    of rows (frame, x1, y1, x2, y2).
+    """
+    pattern = rf"^{movie_id}:(-?\d+):(-?\d+)_(-?\d+)_(-?\d+)_(-?\d+)\.jpeg$"
+    matches = re.findall(pattern, "\n".join(images), flags=re.MULTILINE)
+    return np.array(matches, dtype=np.int64).reshape(-1, 5)
+
+def rows_in(rows, other_rows):
+    """Mask of the rows of a 2D array that are also rows of another array.
+    """
+    def as_items(a):
+        a = np.ascontiguousarray(a, dtype=np.int64)
+        return a.view(np.dtype((np.void, a.dtype.itemsize * a.shape[1]))).ravel()
+    return np.isin(as_items(rows), as_items(other_rows))
+
+def read_fps(movie_path):
+    """Read movie fps from file so that frontend can compute hh:mm:ss for frames!
+    """
+    if movie_path is None:
+        return 25.0
+    cap = cv2.VideoCapture(movie_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    cap.release()
+    return fps
+
+def parse_datadir(dir, movie_id: int, movie_path, items_per_trajectory: int):
+    """Parse trajectories, clusters and predictions in one *-data directory.
+    """
+    trajectories_file = os.path.join(dir, "trajectories.jsonl")
+    clusters_file = os.path.join(dir, "clusters.json")
+    predictions_file = os.path.join(dir, "predictions.json")
+    images_dir = os.path.join(dir, "images")
+
+    if has_pack(dir):
+        image_boxes = read_pack_boxes(dir)
+    else:
+        image_boxes = read_image_boxes(os.listdir(images_dir), movie_id)
+
+    # Read all trajectories for this movie, and compute the frame of each box
+    starts, offsets, boxes = read_trajectories(trajectories_file)
+    n_trajectories = len(starts)
+    box_trajectories = np.repeat(np.arange(n_trajectories), np.diff(offsets))
+    frames = starts[box_trajectories] + np.arange(len(boxes)) - offsets[box_trajectories]
+
+    # Filter trajectories to have only boxes that have an image.
+    # Rows are: (frame, x1, y1, x2, y2), grouped by trajectory
+    rows = np.column_stack([frames, boxes])
+    has_image = rows_in(rows, image_boxes)
+    image_rows = rows[has_image]
+    image_trajectories = box_trajectories[has_image]
+    n_images = np.bincount(image_trajectories, minlength=n_trajectories)
+    image_offsets = np.concatenate([[0], np.cumsum(n_images)])
+
+    # Read clusters corresponing to each trajectory
+    with open(clusters_file, "r") as f:
+        cluster_indices = np.array(json.load(f)["clusters"], dtype=np.int64)
+        assert len(cluster_indices) == n_trajectories, "All trajectories need a cluster!"
+
+    # TODO: smarter selection of images to show?
+    positions, mask = split_evenly(n_images, items_per_trajectory)
+    shown = (image_offsets[:-1, None] + positions)[mask]
+    shown_rows = image_rows[shown]
+    shown_trajectories = image_trajectories[shown]
+
+    # Compute better image lookup table for clusters
+    # Note: trajectories are implicitly indexed by their order in the list
+    # Cluster indices are assumed to be dense, from zero
+    cluster_ids, cluster_of_trajectory = np.unique(cluster_indices, return_inverse=True)
+    n_cluster_ids = len(cluster_ids)
+    n_cluster_trajectories = np.bincount(cluster_of_trajectory, minlength=n_cluster_ids)
+    n_cluster_images = np.bincount(cluster_of_trajectory, weights=n_images, minlength=n_cluster_ids)
+    shown_clusters = cluster_of_trajectory[shown_trajectories]
+    n_cluster_shown = np.bincount(shown_clusters, minlength=n_cluster_ids)
+
+    # Shown images grouped by cluster, still in trajectory order
+    order = np.argsort(shown_clusters, kind="stable")
+    clusters = Clusters(
+        ids=cluster_ids,
+        counts=np.column_stack([n_cluster_trajectories, n_cluster_shown, n_cluster_images]).astype(np.int64),
+        offsets=np.concatenate([[0], np.cumsum(n_cluster_shown)]),
+        images=np.column_stack([shown_trajectories, shown_rows])[order].astype(np.int32),
+    )
+
+    # Uniquely map (frame, *box) -> trajectory id for every shown image
+    trajectory_map = TrajectoryMap.from_rows(shown_rows, shown_trajectories)
+
+    # Read per-cluster predictions
+    with open(predictions_file, "r") as f:
+        predictions = json.load(f)["predictions"]
+        # Convert keys to integers (JSON only has string keys)
+        predictions = {
+            int(cluster_id): {actor_id: p for actor_id, p in cluster_preds.items()}
+            for cluster_id, cluster_preds in predictions.items()
+        }
+        assert len(predictions) == len(clusters), "Predictions not equal to clusters!"
+
+    return {
+        "id": movie_id,
+        "path": dir,
+        "movie_path": movie_path,
+        "clusters": clusters,
+        "n_clusters": len(clusters),
+        "predictions": predictions,
+        "trajectory_map": trajectory_map,
+        "fps": read_fps(movie_path),
+    }
+
+def snapshot_key(dir, movie_path, items_per_trajectory: int):
+    """Identifies the files (and settings) that the data of a movie is parsed from.
+    """
+    sources = [os.path.join(dir, name) for name in (
+        "trajectories.jsonl", "clusters.json", "predictions.json",
+        INDEX_NAME if has_pack(dir) else "images",
+    )]
+    if movie_path is not None:
+        sources.append(movie_path)
+    return {
+        "sources": source_stamps(sources),
+        "items_per_trajectory": items_per_trajectory,
+    }
+
+def read_datadir(dir, movie_id: int, movie_path, cache_dir: str, items_per_trajectory: int):
+    """Read data of one movie, from its snapshot if the *-data directory (and
+    movie file) didn't change since the snapshot was saved.
+    """
+    key = snapshot_key(dir, movie_path, items_per_trajectory)
+    snapshot_dir = os.path.join(cache_dir, "snapshots", str(movie_id))
+    data = load_snapshot(snapshot_dir, key)
+    if data is not None:
+        return data
+
+    # Backend workers that start together parse each movie only once
+    with file_lock(f"{snapshot_dir}.lock"):
+        data = load_snapshot(snapshot_dir, key)
+        if data is None:
+            data = parse_datadir(dir, movie_id, movie_path, items_per_trajectory)
+            try:
+                save_snapshot(snapshot_dir, data, key)
+            except OSError:
+                print(f"Could not save snapshot for: {movie_id}")
+                return data
+            # Use the memory-mapped arrays, which are shared with other workers
+            data = load_snapshot(snapshot_dir, key) or data
+    return data
+
+def read_summary(dir, movie_id: int, movie_path, cache_dir: str, items_per_trajectory: int, parse: bool):
+    """Get the few fields that listing a movie needs, without keeping its full
+    data in memory. Comes from the snapshot when there is a valid one.
+
+    If parse is true, a missing snapshot is created by parsing the movie, so
+    that loading it later is fast. Otherwise only clusters.json is read.
+    """
+    key = snapshot_key(dir, movie_path, items_per_trajectory)
+    snapshot_dir = os.path.join(cache_dir, "snapshots", str(movie_id))
+    meta = load_snapshot_meta(snapshot_dir, key)
+
+    if meta is not None:
+        n_clusters, fps = meta["n_clusters"], meta["fps"]
+    elif parse:
+        data = read_datadir(dir, movie_id, movie_path, cache_dir, items_per_trajectory)
+        n_clusters, fps = data["n_clusters"], data["fps"]
+    else:
+        with open(os.path.join(dir, "clusters.json"), "r") as f:
+            n_clusters = len(set(json.load(f)["clusters"]))
+        fps = read_fps(movie_path)
+
+    return {
+        "id": movie_id,
+        "path": dir,
+        "movie_path": movie_path,
+        "n_clusters": n_clusters,
+        "fps": fps,
+    }
+
+def read_summaries(data_dir: str, films_dir: str, cache_dir: str, items_per_trajectory: int, parse: bool, n_workers: int):
+    """Summaries of all movies in data_dir, read in parallel by a process pool.
+    Returns a dict: movie_id -> summary
+    """
+    # Expand potential globs
+    # data_dir contains folders like 12345-data for each movie
+    dirs = glob.glob(f"{data_dir}/*-data")
+
+    # Map movie ids to movie paths
+    movie_path_map = {}
+    _, _, movie_files = next(os.walk(films_dir))
+    for name in sorted(movie_files):
+        try:
+            movie_id = int(name.split("-")[0])
+            movie_path_map[movie_id] = os.path.join(films_dir, name)
+        except:
+            pass
+
+    jobs = []
+    for dir in dirs:
+        movie_id = int(os.path.basename(dir).split("-")[0])
+        movie_path = movie_path_map.get(movie_id)
+        jobs.append((dir, movie_id, movie_path, cache_dir, items_per_trajectory, parse))
+
+    # Backend workers that start together begin from different movies, so that
+    # they don't wait for each other on the same snapshot locks
+    k = os.getpid() % max(len(jobs), 1)
+    rotated = jobs[k:] + jobs[:k]
+
+    # Fork: the backend's main module can't be imported again in workers. A
+    # process that already runs other threads can't be forked safely though,
+    # since a lock held by one of them would stay locked in the children.
+    if threading.active_count() > 1 and n_workers > 1:
+        print("Other threads are running, reading movies in a single process.")
+        n_workers = 1
+
+    if n_workers > 1 and len(jobs) > 1:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+            summaries = list(executor.map(read_summary, *zip(*rotated)))
+    else:
+        summaries = [read_summary(*job) for job in rotated]
+
+    summaries = {summary["id"]: summary for summary in summaries}
+    return {movie_id: summaries[movie_id] for _, movie_id, *_ in jobs}
+
+class MovieRegistry(Mapping):
+    """Data of all movies, by movie id. Full data of a movie is loaded when it
+    is first accessed, while summary() is always available.
+    """
+    def __init__(self, summaries: Dict[int, dict], load: Callable[[dict], dict]):
+        self.summaries = summaries
+        self.load = load
+        self.loaded = {}
+        self.locks = {movie_id: threading.Lock() for movie_id in summaries}
+
+    def summary(self, movie_id: int):
+        return self.summaries[movie_id]
+
+    def __getitem__(self, movie_id: int):
+        data = self.loaded.get(movie_id)
+        if data is not None:
+            return data
+        if movie_id not in self.summaries:
+            raise KeyError(movie_id)
+
+        # Load each movie only once, even with concurrent first requests
+        with self.locks[movie_id]:
+            if movie_id not in self.loaded:
+                summary = self.summaries[movie_id]
+                self.loaded[movie_id] = {**self.load(summary), **summary}
+        return self.loaded[movie_id]
+
+    def __contains__(self, movie_id):
+        return movie_id in self.summaries
+
+    def __iter__(self):
+        return iter(self.summaries)
+
+    def __len__(self):
+        return len(self.summaries)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import traceback
+
+class FramePrefetcher:
+    """Warms up full frames of the clusters that an annotator will open next.
+
+    Work runs on a small pool of background threads. Each annotator (user and
+    movie) has a generation: when they open another cluster, work that was
+    scheduled for their earlier clusters is cancelled. The max_sessions
+    annotators that were active most recently are remembered.
+    """
+    def __init__(self, warm_cluster, n_ahead=2, n_workers=2, max_pending=64, max_sessions=1000):
+        # warm_cluster(movie_id, cluster_id, cancelled) renders and caches the
+        # frames of a cluster, and polls cancelled() to stop early.
+        self.warm_cluster = warm_cluster
+        self.n_ahead = n_ahead
+        self.max_pending = max_pending
+        self.n_pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        # (username, movie_id) -> (generation, last cluster id), least recently
+        # active first. Generations are unique, so that work of a forgotten
+        # session is never taken for that of a new one.
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.generations = itertools.count(1)
+
+    def schedule(self, username: str, movie_id: int, cluster_id: int, n_clusters: int):
+        """Schedule frames of a cluster and the next n_ahead clusters, in the
+        direction that the annotator is moving.
+        """
+        if self.n_ahead < 0 or n_clusters == 0:
+            return
+
+        key = (username, movie_id)
+        with self.lock:
+            _, last_cluster = self.sessions.pop(key, (None, None))
+            generation = next(self.generations)
+            self.sessions[key] = (generation, cluster_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+            # Clusters wrap around at the ends, like in the frontend
+            step = -1 if last_cluster == (cluster_id + 1) % n_clusters else 1
+            cluster_ids = {(cluster_id + step * k) % n_clusters for k in range(self.n_ahead + 1)}
+            # Nearest cluster first
+            cluster_ids = sorted(cluster_ids, key=lambda ci: ((ci - cluster_id) * step) % n_clusters)
+
+            # Prefetching is optional work, drop it when too far behind
+            n_scheduled = min(len(cluster_ids), self.max_pending - self.n_pending)
+            self.n_pending += max(0, n_scheduled)
+
+        for ci in cluster_ids[:n_scheduled]:
+            self.executor.submit(self._run, key, generation, movie_id, ci)
+
+    def _run(self, key, generation: int, movie_id: int, cluster_id: int):
+        cancelled = lambda: self.sessions.get(key, (None,))[0] != generation
+        try:
+            if not cancelled():
+                self.warm_cluster(movie_id, cluster_id, cancelled)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.n_pending -= 1
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,368 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+import os
+import re
+import sys
+import glob
+import hmac
+import json
+import time
+import random
+import asyncio
+import functools
+import itertools
+import tempfile
+import threading
+import traceback
+
+from fastapi.routing import APIRoute
+
+from metrics import match_route
+
+# Sampling profiler for single requests. A request is profiled when it has the
+# admin token in its X-Profile-Token header, or for a random fraction of all
+# requests. With slow-request capture on, every request is profiled, and the
+# profile is kept only if the request took longer than the threshold.
+#
+# Only threads that work on the request are sampled: the thread that runs the
+# endpoint, and those that run functions decorated with @profiled for it. When
+# no request is profiled, the sampler thread sleeps.
+
+TOKEN_HEADER = b"x-profile-token"
+
+# Max number of database calls recorded per profile
+MAX_QUERIES = 1000
+
+# Saved profiles are named <unix time ms>-<pid>-<n>
+PROFILE_NAME = re.compile(r"^\d+-\d+-\d+$")
+
+# Profile of the request being handled, if it is profiled
+CURRENT_PROFILE: ContextVar[Optional["Profile"]] = ContextVar("profile", default=None)
+
+class Profile:
+    def __init__(self, name: str, method: str, path: str, route: str, reason: str):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.route = route
+        # "header", "sampled" or "slow" (kept only if the request was slow)
+        self.reason = reason
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        # Thread id -> frame, samples of the thread are its stack above the frame
+        self.threads: Dict[int, object] = {}
+        # Stack (code objects, outermost first) -> number of samples
+        self.stacks: Dict[tuple, int] = {}
+        self.n_ticks = 0
+        # Database calls: (name, start in seconds from the request start, seconds)
+        self.queries = []
+
+    @contextmanager
+    def attach(self, frame):
+        """Sample the current thread while in the block, from frame up.
+        """
+        thread_id = threading.get_ident()
+        if thread_id in self.threads:
+            # Nested call on the same thread, already sampled
+            yield
+            return
+        self.threads[thread_id] = frame
+        try:
+            yield
+        finally:
+            del self.threads[thread_id]
+
+    def add_query(self, name: str, start: float, seconds: float):
+        if len(self.queries) < MAX_QUERIES:
+            self.queries.append((name, start - self.start, seconds))
+
+def profiled(fn):
+    """Decorator for functions whose thread should be sampled when they run
+    for a profiled request: endpoints, and work handed to other threads.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            profile = CURRENT_PROFILE.get()
+            if profile is None:
+                return await fn(*args, **kwargs)
+            # The coroutine's frame is on the stack only while it runs, so the
+            # event loop running other requests is not counted
+            with profile.attach(sys._getframe()):
+                return await fn(*args, **kwargs)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = CURRENT_PROFILE.get()
+            if profile is None:
+                return fn(*args, **kwargs)
+            with profile.attach(sys._getframe()):
+                return fn(*args, **kwargs)
+    return wrapper
+
+class ProfiledRoute(APIRoute):
+    """Route whose endpoint is @profiled, for app.router.route_class.
+    """
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+def frame_name(code):
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def folded(profile: dict):
+    """Profile in the collapsed stack format ("frame;frame;frame count" per
+    line), for flamegraph.pl, speedscope and others.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].items())
+
+class Profiler:
+    """Samples the stacks of profiled requests every interval seconds, and
+    saves their profiles in directory, keeping the newest max_profiles.
+
+    Sample rate and slow-request threshold can be changed at runtime with
+    set_settings(). They are saved in directory, so that all workers use them.
+    Requests are only sampled once start_thread() is called.
+    """
+    def __init__(
+        self, directory: str, routes: Callable[[], list], token: Optional[str] = None,
+        sample_rate=0.0, slow_ms=0.0, interval=0.01, max_profiles=200,
+    ):
+        self.directory = directory
+        self.routes = routes
+        self.token = token
+        self.defaults = {"sample_rate": sample_rate, "slow_ms": slow_ms}
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval
+        self.max_profiles = max_profiles
+        os.makedirs(directory, exist_ok=True)
+        self.settings_path = os.path.join(directory, "settings.conf")
+        self.settings_mtime = None
+        self.next_settings_check = 0.0
+        self.counter = itertools.count()
+
+        self.active = set()
+        self.finished = []
+        self.condition = threading.Condition()
+
+    def start_thread(self):
+        thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        thread.start()
+
+    def is_admin(self, token: Optional[str]):
+        if self.token is None or token is None:
+            return False
+        return hmac.compare_digest(token.encode(), self.token.encode())
+
+    def settings(self):
+        self._reload_settings()
+        return {"sample_rate": self.sample_rate, "slow_ms": self.slow_ms}
+
+    def set_settings(self, sample_rate: float, slow_ms: float):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"sample_rate": sample_rate, "slow_ms": slow_ms}, f)
+        os.replace(tmp_path, self.settings_path)
+        self.next_settings_check = 0.0
+
+    def _reload_settings(self):
+        """Settings from the file, if it changed. Checked at most once a second.
+        """
+        now = time.monotonic()
+        if now < self.next_settings_check:
+            return
+        self.next_settings_check = now + 1.0
+        try:
+            mtime = os.stat(self.settings_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.settings_mtime:
+            return
+        self.settings_mtime = mtime
+        settings = self.defaults
+        if mtime is not None:
+            try:
+                with open(self.settings_path, "r") as f:
+                    settings = {**self.defaults, **json.load(f)}
+            except (OSError, ValueError):
+                traceback.print_exc()
+        self.sample_rate = float(settings["sample_rate"])
+        self.slow_ms = float(settings["slow_ms"])
+
+    def start(self, scope) -> Optional[Profile]:
+        """Start the profile of a request (ASGI scope), or None if the request
+        is not profiled.
+        """
+        self._reload_settings()
+        if scope["path"].startswith("/api/profiles"):
+            return None
+
+        if self.token is not None and any(
+            name == TOKEN_HEADER and self.is_admin(value.decode("latin-1")) for name, value in scope["headers"]
+        ):
+            reason = "header"
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            reason = "sampled"
+        elif self.slow_ms > 0:
+            reason = "slow"
+        else:
+            return None
+
+        name = f"{int(time.time() * 1000)}-{os.getpid()}-{next(self.counter)}"
+        profile = Profile(name, scope["method"], scope["path"], match_route(self.routes(), scope), reason)
+        with self.condition:
+            self.active.add(profile)
+            self.condition.notify()
+        return profile
+
+    def finish(self, profile: Profile, status: int):
+        profile.duration = time.perf_counter() - profile.start
+        profile.status = status
+        with self.condition:
+            self.active.discard(profile)
+            if profile.reason != "slow" or 1000 * profile.duration >= self.slow_ms:
+                # Saved by the sampler thread, off the event loop
+                self.finished.append(profile)
+                self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.active and not self.finished:
+                    self.condition.wait()
+                active = list(self.active)
+                finished, self.finished = self.finished, []
+
+            if active:
+                self._sample(active)
+            for profile in finished:
+                try:
+                    self._save(profile)
+                except OSError:
+                    traceback.print_exc()
+            if active:
+                time.sleep(self.interval)
+
+    def _sample(self, profiles):
+        frames = sys._current_frames()
+        for profile in profiles:
+            profile.n_ticks += 1
+            for thread_id, top in list(profile.threads.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame is not top:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if frame is None or not stack:
+                    # Thread is not running the request right now
+                    continue
+                stack = tuple(reversed(stack))
+                profile.stacks[stack] = profile.stacks.get(stack, 0) + 1
+
+    def _save(self, profile: Profile):
+        names = {}
+        stacks = {}
+        for stack, count in profile.stacks.items():
+            frames = [f"{profile.method} {profile.route}"]
+            for code in stack:
+                if code not in names:
+                    names[code] = frame_name(code)
+                frames.append(names[code])
+            line = ";".join(frames)
+            stacks[line] = stacks.get(line, 0) + count
+
+        data = {
+            "name": profile.name,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(profile.time)),
+            "method": profile.method,
+            "path": profile.path,
+            "route": profile.route,
+            "status": profile.status,
+            "reason": profile.reason,
+            "worker": os.getpid(),
+            "duration_ms": round(1000 * profile.duration, 3),
+            "interval_ms": 1000 * self.interval,
+            "ticks": profile.n_ticks,
+            "samples": sum(stacks.values()),
+            "queries": [
+                {"query": name, "start_ms": round(1000 * start, 3), "duration_ms": round(1000 * seconds, 3)}
+                for name, start, seconds in profile.queries
+            ],
+            "stacks": stacks,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, os.path.join(self.directory, f"{profile.name}.json"))
+        self._trim()
+
+    def _paths(self):
+        """Paths of saved profiles, oldest first.
+        """
+        paths = glob.glob(os.path.join(self.directory, "[0-9]*.json"))
+        return sorted(paths, key=lambda path: [int(n) for n in os.path.basename(path)[:-5].split("-")])
+
+    def _trim(self):
+        for path in self._paths()[:-self.max_profiles]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        """Saved profiles, newest first, without stacks and queries.
+        """
+        profiles = []
+        for path in reversed(self._paths()):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            data["queries"] = len(data["queries"])
+            del data["stacks"]
+            profiles.append(data)
+        return profiles
+
+    def read(self, name: str):
+        if not PROFILE_NAME.match(name):
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{name}.json"), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+class ProfilerMiddleware:
+    """ASGI middleware that profiles requests with a Profiler. The name of a
+    profile that was asked for with the header is in the X-Profile response
+    header.
+    """
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        profile = self.profiler.start(scope) if scope["type"] == "http" else None
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if profile.reason == "header":
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile", profile.name.encode())]
+            await send(message)
+
+        token = CURRENT_PROFILE.set(profile)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            CURRENT_PROFILE.reset(token)
+            self.profiler.finish(profile, status[0])
@@ -0,0 +1,189 @@
+from typing import Dict, List, Optional
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from cluster_data import Clusters, TrajectoryMap
+
+# Binary snapshots of parsed movie data, so that restarts don't need to parse
+# every *-data directory again. Each movie is stored in its own directory with
+# the numpy arrays of its clusters and trajectory map, and a meta.json. A
+# snapshot is only used if the files it was built from are unchanged.
+
+# Bump when the snapshot layout or the parsing that produces it changes
+SNAPSHOT_VERSION = 3
+
+def source_stamps(paths: List[str]):
+    """Size and modification time of each source file (or directory), which
+    together identify the version of the file.
+    """
+    stamps = {}
+    for path in paths:
+        stat = os.stat(path)
+        stamps[path] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+def save_snapshot(snapshot_dir: str, data: dict, key: dict):
+    """Save parsed data of one movie. key identifies everything the data was
+    parsed from, and has to match when loading.
+    """
+    arrays = {**data["clusters"].arrays(), **data["trajectory_map"].arrays()}
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "key": key,
+        "id": data["id"],
+        "path": data["path"],
+        "movie_path": data["movie_path"],
+        "fps": data["fps"],
+        "n_clusters": data["n_clusters"],
+        "arrays": sorted(arrays),
+        # JSON only has string keys, converted back when loading
+        "predictions": {str(ci): preds for ci, preds in data["predictions"].items()},
+    }
+
+    # Write into a temporary directory first, and swap it in when complete
+    parent = os.path.dirname(snapshot_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.rename(tmp_dir, snapshot_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def load_snapshot_meta(snapshot_dir: str, key: dict) -> Optional[dict]:
+    """Load only the small meta.json part of a snapshot, or None if there is
+    no snapshot that matches the key.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != SNAPSHOT_VERSION or meta.get("key") != key:
+        return None
+    return meta
+
+def load_snapshot(snapshot_dir: str, key: dict) -> Optional[dict]:
+    """Load parsed data of one movie, or None if there is no snapshot that
+    matches the key.
+    """
+    meta = load_snapshot_meta(snapshot_dir, key)
+    if meta is None:
+        return None
+
+    try:
+        # Memory-mapped, so that processes that load the same snapshot share it
+        arrays = {
+            name: np.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode="r")
+            for name in meta["arrays"]
+        }
+    except (OSError, ValueError):
+        return None
+    clusters = Clusters.from_arrays(arrays)
+
+    predictions = {
+        int(cluster_id): cluster_preds for cluster_id, cluster_preds in meta["predictions"].items()
+    }
+
+    return {
+        "id": meta["id"],
+        "path": meta["path"],
+        "movie_path": meta["movie_path"],
+        "clusters": clusters,
+        "n_clusters": len(clusters),
+        "predictions": predictions,
+        "trajectory_map": TrajectoryMap.from_arrays(arrays),
+        "fps": meta["fps"],
+    }
+
+def _column_to_array(values):
+    """Numpy array of a DataFrame column or index level that can be loaded
+    without pickle, and a mask of missing values for string columns.
+    """
+    values = np.asarray(values)
+    if values.dtype != object:
+        return values, None
+    missing = pd.isna(values)
+    if not all(isinstance(v, str) for v in values[~missing]):
+        raise TypeError("Only string columns of type object can be saved.")
+    strings = np.where(missing, "", values).astype(str)
+    return strings, missing
+
+def _array_to_column(values, missing):
+    if missing is None:
+        return values
+    values = values.astype(object)
+    values[missing] = np.nan
+    return values
+
+def save_dataframes(path: str, dataframes: List[pd.DataFrame], key: dict):
+    """Save DataFrames with numeric and string columns in a .npz file, which
+    unlike pickle can't run code when loaded. key identifies everything the
+    DataFrames were made from, and has to match when loading.
+    """
+    arrays = {}
+    frames_meta = []
+    for i, df in enumerate(dataframes):
+        frame_meta = {"index": list(df.index.names), "columns": list(df.columns), "missing": []}
+        parts = [("index", level, df.index.get_level_values(level)) for level in range(df.index.nlevels)]
+        parts += [("column", k, df.iloc[:, k]) for k in range(df.shape[1])]
+        for kind, k, values in parts:
+            name = f"{i}_{kind}{k}"
+            arrays[name], missing = _column_to_array(values)
+            if missing is not None:
+                arrays[f"{name}_missing"] = missing
+                frame_meta["missing"].append(name)
+        frames_meta.append(frame_meta)
+    meta = {"version": SNAPSHOT_VERSION, "key": key, "frames": frames_meta}
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def load_dataframes(path: str, key: dict) -> Optional[List[pd.DataFrame]]:
+    """Load DataFrames saved by save_dataframes, or None if there are none
+    that match the key.
+    """
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta.get("version") != SNAPSHOT_VERSION or meta.get("key") != key:
+                return None
+
+            def column(name, frame_meta):
+                missing = npz[f"{name}_missing"] if name in frame_meta["missing"] else None
+                return _array_to_column(npz[name], missing)
+
+            dataframes = []
+            for i, frame_meta in enumerate(meta["frames"]):
+                levels = [column(f"{i}_index{k}", frame_meta) for k in range(len(frame_meta["index"]))]
+                if len(levels) == 1:
+                    index = pd.Index(levels[0], name=frame_meta["index"][0])
+                else:
+                    index = pd.MultiIndex.from_arrays(levels, names=frame_meta["index"])
+                df = pd.DataFrame({
+                    k: column(f"{i}_column{k}", frame_meta) for k in range(len(frame_meta["columns"]))
+                }, index=index)
+                df.columns = frame_meta["columns"]
+                dataframes.append(df)
+            return dataframes
+    except (OSError, ValueError, KeyError):
+        return None
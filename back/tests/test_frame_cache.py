@@ -0,0 +1,29 @@
+import os
+import time
+
+from frame_cache import DiskCache
+
+def digest(i):
+    return f"{i:064x}"
+
+def test_workers_share_disk_budget(tmp_path):
+    directory = str(tmp_path / "frames")
+    first = DiskCache(directory, max_bytes=10_000)
+    for i in range(5):
+        first.put(digest(i), b"x" * 1000)
+        time.sleep(0.01)
+
+    # A worker that starts later must not evict down to a part of the budget
+    second = DiskCache(directory, max_bytes=10_000)
+    second.put(digest(5), b"x" * 1000)
+    assert all(first.get(digest(i)) is not None for i in range(6))
+
+    # Over the budget, the least recently used files of all workers go
+    assert first.get(digest(0)) is not None
+    for i in range(6, 12):
+        time.sleep(0.01)
+        second.put(digest(i), b"x" * 1000)
+    assert first.get(digest(0)) is not None
+    assert second.get(digest(1)) is None
+    assert sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory)
+               for name in names if name.endswith(".jpeg")) <= 10_000
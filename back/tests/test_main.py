@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "extra", "benchmarks")
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    """Backend on a small synthetic movie, with the in-process stand-in for
+    the database.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import memory_db
+    import synthetic_data
+
+    root = str(tmp_path_factory.mktemp("data"))
+    synthetic_data.generate(root, n_movies=1, n_trajectories=20, n_clusters=4, n_frames=50, n_actors=3)
+    os.environ.update({
+        "DATA_DIR": os.path.join(root, "data"),
+        "FILMS_DIR": os.path.join(root, "films"),
+        "METADATA_DIR": os.path.join(root, "metadata"),
+        "CACHE_DIR": os.path.join(root, "cache"),
+        "DB_PASSWORD": "",
+        "PREFETCH_CLUSTERS": "-1",
+    })
+    memory_db.install()
+    import main
+
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+def test_frame(client):
+    movie_id = client.get("/api/movies").json()[0]["id"]
+    response = client.get(f"/images/frames/{movie_id}/10_10-10-50-50.jpeg")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+
+def test_frame_etag_follows_film(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "FILM_STAT_SECONDS", 0.0)
+    movie_id = client.get("/api/movies").json()[0]["id"]
+    url = f"/images/frames/{movie_id}/10_10-10-50-50.jpeg"
+    etag = client.get(url).headers["etag"]
+    assert client.get(url).headers["etag"] == etag
+
+    # Replaced film, with the same name
+    movie_path = main.dir_data.summary(movie_id)["movie_path"]
+    stat = os.stat(movie_path)
+    os.utime(movie_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert client.get(url).headers["etag"] != etag
+
+@pytest.mark.parametrize("frame_index", [-1, 50, 10 ** 6])
+def test_frame_out_of_range(client, frame_index):
+    movie_id = client.get("/api/movies").json()[0]["id"]
+    response = client.get(f"/images/frames/{movie_id}/{frame_index}_10-10-50-50.jpeg")
+    assert response.status_code == 400
+
+def test_invalid_cluster(client):
+    movie_id = client.get("/api/movies").json()[0]["id"]
+    assert client.get(f"/api/faces/clusters/{movie_id}/1000").status_code == 404
+
+def test_movie_packed_while_running(client):
+    import main
+    from image_pack import build_pack
+    movie_id = client.get("/api/movies").json()[0]["id"]
+    url = client.get(f"/api/faces/clusters/{movie_id}/0").json()["images"][0]["url"]
+    content = client.get(f"/{url}").content
+
+    # Like image_pack.py --remove-images
+    movie_dir = main.dir_data.summary(movie_id)["path"]
+    build_pack(movie_dir, movie_id)
+    os.rename(os.path.join(movie_dir, "images"), os.path.join(movie_dir, "images.old"))
+    try:
+        response = client.get(f"/{url}")
+    finally:
+        os.rename(os.path.join(movie_dir, "images.old"), os.path.join(movie_dir, "images"))
+    assert response.status_code == 200
+    assert response.content == content
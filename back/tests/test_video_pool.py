@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+import pytest
+
+from video_pool import VideoPool
+
+N_FRAMES = 120
+
+@pytest.fixture(scope="module")
+def movie_path(tmp_path_factory):
+    """Short video with the index of each frame in its top row of blocks,
+    one bit per block.
+    """
+    path = str(tmp_path_factory.mktemp("films") / "1-test.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 25.0, (64, 48))
+    for i in range(N_FRAMES):
+        frame = np.zeros((48, 64, 3), np.uint8)
+        for bit in range(7):
+            if i >> bit & 1:
+                frame[:8, 8 * bit:8 * bit + 8] = 255
+        writer.write(frame)
+    writer.release()
+    return path
+
+def frame_number(frame):
+    return sum(1 << bit for bit in range(7) if frame[:8, 8 * bit:8 * bit + 8].mean() > 127)
+
+def test_read_after_failed_read(movie_path):
+    pool = VideoPool(max_open=1, max_per_movie=1)
+    with pool.reader(1, movie_path, 100) as reader:
+        assert reader.read(N_FRAMES + 500) is None
+        # Same decoder, after the failed read
+        for frame_index in (5, 50, N_FRAMES - 1):
+            frame = reader.read(frame_index)
+            assert frame is not None
+            assert frame_number(frame) == frame_index
+    pool.close()
+
+def test_decoder_closed_after_failed_read(movie_path):
+    pool = VideoPool(max_open=1, max_per_movie=1)
+    with pool.reader(1, movie_path, 0) as reader:
+        assert reader.read(N_FRAMES + 500) is None
+    assert pool.n_open == 0
+
+    with pool.reader(1, movie_path, 5) as reader:
+        assert frame_number(reader.read(5)) == 5
+    pool.close()
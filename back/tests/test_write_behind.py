@@ -0,0 +1,23 @@
+from write_behind import WriteBehindClient
+
+class EmptyDatabase:
+    def get_annotations_batch(self, username, movie_id, cluster_ids):
+        return {}
+
+def test_workers_see_each_others_saves(tmp_path):
+    # Two backend workers with their own journals in the same directory
+    first = WriteBehindClient(EmptyDatabase(), str(tmp_path))
+    second = WriteBehindClient(EmptyDatabase(), str(tmp_path))
+
+    first.insert_annotations("user", 1, 3, "actor-1", [("tag", "same", 0)], "labeled", 10)
+    assert second.get_annotations("user", 1, 3)["label"] == "actor-1"
+
+    # The newest save of a cluster wins, whichever worker took it
+    second.insert_annotations("user", 1, 3, "actor-2", [("tag", "same", 0)], "labeled", 10)
+    assert first.get_annotations("user", 1, 3)["label"] == "actor-2"
+    assert second.get_annotations("user", 1, 3)["label"] == "actor-2"
+
+    # Removal (back to initial state) too
+    first.insert_annotations("user", 1, 3, None, [("tag", "same", 0)], "labeled", 10)
+    assert second.get_annotations("user", 1, 3) == {}
+    assert second.get_annotations("user", 2, 3) == {}
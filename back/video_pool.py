@@ -0,0 +1,233 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+import threading
+
+import cv2
+
+from keyframes import gop_start, plan_reads
+from metrics import REGISTRY
+
+# Also used for resizing and encoding, see render_frame in main.py
+FRAME_PHASE_SECONDS = REGISTRY.histogram(
+    "frame_phase_duration_seconds",
+    "Time of the steps of getting a full frame: wait (for a free decoder), open, seek, "
+    "skip (decoding forward to the frame), decode, resize and encode.",
+    ("phase",),
+)
+
+class VideoReader:
+    """An open video decoder that remembers which frame it will decode next.
+    """
+    def __init__(self, path: str, max_forward: int, seek_cost: int, decode_threads=0):
+        self.path = path
+        self.max_forward = max_forward
+        self.seek_cost = seek_cost
+        # Sorted keyframe indices of the movie, if known
+        self.keyframes = None
+        # Limit the number of threads that FFmpeg decodes with (0: automatic)
+        params = []
+        if decode_threads > 0 and hasattr(cv2, "CAP_PROP_N_THREADS"):
+            params = [cv2.CAP_PROP_N_THREADS, decode_threads]
+        with FRAME_PHASE_SECONDS.time(phase="open"):
+            self.cap = cv2.VideoCapture(path, cv2.CAP_ANY, params)
+        self.n_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Index of the frame that the next cap.read() returns
+        self.position = 0
+
+    def distance(self, frame_index: int):
+        """Number of frames to decode forward to reach frame_index, or None if
+        reaching it would require a seek.
+        """
+        if self.position < 0:
+            # Position is unknown after a failed seek or read
+            return None
+        forward = frame_index - self.position
+        if forward < 0:
+            return None
+
+        if self.keyframes:
+            # A seek decodes from the keyframe of the target GOP. Go forward
+            # unless that keyframe is (clearly) ahead of the current position.
+            if gop_start(self.keyframes, frame_index) - self.position > self.seek_cost:
+                return None
+        elif forward > self.max_forward:
+            return None
+        return forward
+
+    def read(self, frame_index: int):
+        """Decode frame at frame_index. Nearby frames ahead of the current
+        position are reached by decoding forward, others with a seek. Returns
+        None on errors, and the next read seeks.
+        """
+        if self.distance(frame_index) is None:
+            with FRAME_PHASE_SECONDS.time(phase="seek"):
+                seeked = self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            if not seeked:
+                # Position is unknown after a failed seek, force a seek next time
+                self.position = -1
+                return None
+            self.position = frame_index
+
+        # grab() decodes without converting the frame, so skipping is cheap(er)
+        if self.position < frame_index:
+            with FRAME_PHASE_SECONDS.time(phase="skip"):
+                while self.position < frame_index:
+                    if not self.cap.grab():
+                        # Position is unknown after a failed grab, force a seek next time
+                        self.position = -1
+                        return None
+                    self.position += 1
+
+        with FRAME_PHASE_SECONDS.time(phase="decode"):
+            ret, frame = self.cap.read()
+        if not ret:
+            # Position is unknown after a failed read, force a seek next time
+            self.position = -1
+            return None
+        self.position += 1
+        return frame
+
+    def iter_frames(self, frame_indices):
+        """Decode many frames in one pass, with each GOP decoded at most once.
+        Yields tuples (frame_index, frame), where frame is None on read errors.
+        """
+        for _, group in plan_reads(frame_indices, self.keyframes):
+            for frame_index in group:
+                yield frame_index, self.read(frame_index)
+
+    def read_many(self, frame_indices):
+        """Like iter_frames, but returns a dict: frame_index -> frame
+        """
+        return dict(self.iter_frames(frame_indices))
+
+    def release(self):
+        self.cap.release()
+
+class VideoPool:
+    """Bounded pool of open video decoders, shared by all movies.
+
+    Idle decoders are kept per movie, and movies are evicted in least recently
+    used order when the total number of open decoders hits max_open.
+    """
+    def __init__(
+        self, max_open=16, max_per_movie=2, max_forward=120, seek_cost=24,
+        decode_threads=0, keyframe_index=None,
+    ):
+        self.max_open = max_open
+        self.max_per_movie = max_per_movie
+        self.max_forward = max_forward
+        self.seek_cost = seek_cost
+        self.decode_threads = decode_threads
+        self.keyframe_index = keyframe_index
+        self.n_open = 0
+        # movie_id -> list of idle readers, least recently used movie first
+        self.idle = OrderedDict()
+        self.cond = threading.Condition()
+        REGISTRY.gauge("video_decoders_open", "Open video decoders, in use or idle.", function=lambda: self.n_open)
+
+    def _take_idle(self, movie_id: int, frame_index: int, keyframes):
+        """Pop the idle reader of a movie that is closest to frame_index.
+        """
+        readers = self.idle.get(movie_id)
+        if not readers:
+            return None
+
+        def cost(reader):
+            # The index may have been built after the reader was opened
+            reader.keyframes = keyframes
+            distance = reader.distance(frame_index)
+            return distance if distance is not None else float("inf")
+
+        best = min(readers, key=cost)
+        readers.remove(best)
+        if not readers:
+            del self.idle[movie_id]
+        return best
+
+    def _evict_one(self):
+        """Close the least recently used idle reader. Returns False if every
+        open reader is in use.
+        """
+        if not self.idle:
+            return False
+        movie_id, readers = next(iter(self.idle.items()))
+        readers.pop(0).release()
+        if not readers:
+            del self.idle[movie_id]
+        self.n_open -= 1
+        return True
+
+    def _checkout(self, movie_id: int, path: str, frame_index: int):
+        keyframes = self.keyframe_index.get(movie_id) if self.keyframe_index else None
+        with self.cond:
+            while True:
+                reader = self._take_idle(movie_id, frame_index, keyframes)
+                if reader is not None:
+                    return reader
+                if self.n_open < self.max_open or self._evict_one():
+                    self.n_open += 1
+                    break
+                # All decoders are busy, wait for one to be returned
+                start = time.perf_counter()
+                self.cond.wait()
+                FRAME_PHASE_SECONDS.observe(time.perf_counter() - start, phase="wait")
+
+        # Open the new decoder outside of the lock, this is the slow part
+        try:
+            reader = VideoReader(path, self.max_forward, self.seek_cost, self.decode_threads)
+            reader.keyframes = keyframes
+            return reader
+        except:
+            with self.cond:
+                self.n_open -= 1
+                self.cond.notify()
+            raise
+
+    def _checkin(self, movie_id: int, reader: VideoReader, healthy: bool):
+        with self.cond:
+            readers = self.idle.setdefault(movie_id, [])
+            self.idle.move_to_end(movie_id)
+            if healthy:
+                readers.append(reader)
+            if len(readers) > self.max_per_movie or not healthy:
+                # Drop the reader that is furthest behind in the movie
+                drop = reader if not healthy else min(readers, key=lambda r: r.position)
+                if drop in readers:
+                    readers.remove(drop)
+                drop.release()
+                self.n_open -= 1
+            if not readers:
+                del self.idle[movie_id]
+            self.cond.notify()
+
+    @contextmanager
+    def reader(self, movie_id: int, path: str, frame_index: int = 0):
+        """Check out a decoder for a movie, preferring one that can reach
+        frame_index without seeking. The decoder is returned to the pool after
+        use, or closed if an exception was raised or a read failed while it was
+        checked out.
+        """
+        reader = self._checkout(movie_id, path, frame_index)
+        healthy = False
+        try:
+            yield reader
+            healthy = reader.cap.isOpened() and reader.position >= 0
+        finally:
+            self._checkin(movie_id, reader, healthy)
+
+    def read_frames(self, movie_id: int, path: str, frame_indices):
+        """Decode a batch of frames of one movie with a single decoder.
+        """
+        if not frame_indices:
+            return {}
+        with self.reader(movie_id, path, min(frame_indices)) as reader:
+            return reader.read_many(frame_indices)
+
+    def close(self):
+        with self.cond:
+            for readers in self.idle.values():
+                for reader in readers:
+                    reader.release()
+                    self.n_open -= 1
+            self.idle.clear()
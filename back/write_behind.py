@@ -0,0 +1,346 @@
+from typing import Dict, List, Tuple
+import os
+import glob
+import json
+import time
+import fcntl
+import threading
+import traceback
+
+import psycopg2
+
+# Saves that the database rejects with these are moved to REJECTED_NAME in the
+# journal directory, instead of being retried forever. Other errors (e.g. the
+# database is down) are retried.
+REJECTED_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+REJECTED_NAME = "rejected.jsonl"
+
+class WriteBehindClient:
+    """Wraps a DatabaseClient so that saving annotations doesn't wait for the
+    database. Saves are appended to a local journal, fsync'd, and written to
+    the database in batches by a background thread. Repeated saves of the same
+    cluster are coalesced like in insert_annotations_batch.
+
+    Each process has its own journal in journal_dir. Journals of processes
+    that exited before flushing everything are adopted at startup. Saves that
+    the database rejects are kept in REJECTED_NAME there.
+
+    Reads of annotations overlay saves that are not in the database yet, from
+    the journals of all processes. Other methods (e.g. label counts) go to the
+    database directly, so they lag behind by up to flush_interval seconds.
+
+    Saves are journaled right away, but only written to the database once
+    start_thread() is called.
+    """
+    def __init__(self, db_client, journal_dir: str, flush_interval=1.0, max_batch=500):
+        self.db_client = db_client
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        # Only one flush at a time, so that no save is written twice
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.seq = 0
+        # (username, movie_id, cluster_id) -> list of pending saves, oldest first
+        self.pending: Dict[Tuple[str, int, int], List[dict]] = {}
+        # Journals of other processes: path -> ((mtime, size), saves)
+        self.other_journals: Dict[str, tuple] = {}
+
+        self.journal_dir = journal_dir
+        os.makedirs(journal_dir, exist_ok=True)
+        self.journal_path = os.path.join(journal_dir, f"{os.getpid()}-{time.time_ns()}.jsonl")
+        self.journal = open(self.journal_path, "a")
+        # Held while this process lives, so that no other process adopts the journal
+        fcntl.flock(self.journal.fileno(), fcntl.LOCK_EX)
+        self._adopt_journals(journal_dir)
+
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+
+    def start_thread(self):
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.db_client, name)
+
+    def _adopt_journals(self, journal_dir: str):
+        for path in sorted(glob.glob(os.path.join(journal_dir, "[0-9]*.jsonl"))):
+            if path == self.journal_path:
+                continue
+            with open(path, "r") as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Journal of a running process
+                    continue
+                entries = []
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Last line of a crashed process may be partial
+                        print(f"Skipped a broken line in journal: {path}")
+            if entries:
+                print(f"Adopted {len(entries)} unsaved annotations from journal: {path}")
+                self._append(entries)
+            os.remove(path)
+
+    def _append(self, entries: List[dict]):
+        """Durably append saves to the journal, and queue them.
+        """
+        with self.lock:
+            for entry in entries:
+                self.seq += 1
+                entry["seq"] = self.seq
+                self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            for entry in entries:
+                key = (entry["username"], entry["movie_id"], entry["cluster_id"])
+                self.pending.setdefault(key, []).append(entry)
+            self.wakeup.notify()
+
+    def insert_annotations(self, username, movie_id, cluster_id, label, images, status, time):
+        """Same as DatabaseClient.insert_annotations, but returns once the save
+        is in the journal.
+        """
+        return self.insert_annotations_batch(
+            username, movie_id, [(cluster_id, label, images, status, time)]
+        )
+
+    def insert_annotations_batch(self, username, movie_id, annotations):
+        """Same as DatabaseClient.insert_annotations_batch, but returns once the
+        saves are in the journal.
+        """
+        now = time.time()
+        entries = [{
+            "username": username,
+            "movie_id": movie_id,
+            "cluster_id": cluster_id,
+            "label": label,
+            "images": [list(image) for image in images],
+            "status": status,
+            "time": processing_time,
+            "created_on": now,
+        } for cluster_id, label, images, status, processing_time in annotations]
+
+        try:
+            self._append(entries)
+            return True
+        except OSError:
+            traceback.print_exc()
+            return False
+
+    def get_annotations(self, username, movie_id, cluster_id):
+        annotations = self.get_annotations_batch(username, movie_id, [cluster_id])
+        if annotations is None:
+            return None
+        return annotations.get(cluster_id, {})
+
+    def get_annotations_batch(self, username, movie_id, cluster_ids):
+        """Same as DatabaseClient.get_annotations_batch, with pending saves on top.
+        """
+        annotations = self.db_client.get_annotations_batch(username, movie_id, cluster_ids)
+        if annotations is None:
+            return None
+
+        with self.lock:
+            latest = {key: entries[-1] for key, entries in self.pending.items() if key[1] == movie_id}
+        # A cluster may have been saved through other processes too
+        for entry in self._other_pending(movie_id):
+            key = (entry["username"], entry["movie_id"], entry["cluster_id"])
+            if key not in latest or entry["created_on"] > latest[key]["created_on"]:
+                latest[key] = entry
+
+        for (key_username, _, cluster_id), entry in latest.items():
+            if cluster_id not in cluster_ids:
+                continue
+            own = key_username == username
+            annotation = annotations.get(cluster_id)
+            # Like in the database, the user's own annotation is preferred
+            if not own and annotation is not None and annotation["username"] != key_username:
+                continue
+            if self._is_default(entry):
+                # Removed (back to initial state)
+                annotations.pop(cluster_id, None)
+                continue
+            annotations[cluster_id] = {
+                "movie_id": movie_id,
+                "cluster_id": cluster_id,
+                "username": key_username,
+                "label": entry["label"],
+                "status": entry["status"],
+                "created_on": int(entry["created_on"]),
+                "images": [(tag, status) for tag, status, _ in entry["images"]],
+            }
+        return annotations
+
+    def _other_pending(self, movie_id):
+        """Saves of a movie in the journals of other processes, which are not
+        in the database yet. Journals are read again only when they change.
+        """
+        journals = {}
+        entries = []
+        for path in glob.glob(os.path.join(self.journal_dir, "[0-9]*.jsonl")):
+            if path == self.journal_path:
+                continue
+            try:
+                stat = os.stat(path)
+                version = (stat.st_mtime_ns, stat.st_size)
+                cached = self.other_journals.get(path)
+                if cached is None or cached[0] != version:
+                    saves = []
+                    with open(path, "r") as f:
+                        for line in f:
+                            try:
+                                saves.append(json.loads(line))
+                            except ValueError:
+                                # Line that is being written
+                                pass
+                    cached = (version, saves)
+            except FileNotFoundError:
+                # Flushed and removed
+                continue
+            journals[path] = cached
+            entries.extend(entry for entry in cached[1] if entry["movie_id"] == movie_id)
+        self.other_journals = journals
+        return entries
+
+    @staticmethod
+    def _is_default(entry: dict):
+        return entry["label"] is None and entry["status"] == "labeled" and \
+            all(status == "same" for _, status, _ in entry["images"])
+
+    def flush(self):
+        """Write pending saves to the database, in batches. Returns False if
+        the database failed, and the rest are kept for the next try.
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        while True:
+            with self.lock:
+                keys = list(self.pending)[:self.max_batch]
+                batch = {key: list(self.pending[key]) for key in keys}
+            if not batch:
+                return True
+
+            # One transaction per user and movie
+            groups = {}
+            for (username, movie_id, cluster_id), entries in batch.items():
+                groups.setdefault((username, movie_id), []).extend(entries)
+            try:
+                for (username, movie_id), entries in groups.items():
+                    if not self._write(username, movie_id, entries):
+                        return False
+                    self._done(entries)
+            finally:
+                self._compact_journal()
+
+    def _insert(self, username, movie_id, entries: List[dict]):
+        annotations = [
+            (e["cluster_id"], e["label"], [tuple(i) for i in e["images"]], e["status"], e["time"])
+            for e in entries
+        ]
+        self.db_client.insert_annotations_batch(username, movie_id, annotations, raise_errors=True)
+
+    def _write(self, username, movie_id, entries: List[dict]):
+        """Write saves of a user and movie in one transaction. If the database
+        rejects it, the saves are written one by one, and the rejected ones are
+        set aside. Returns False if the database failed otherwise.
+        """
+        try:
+            self._insert(username, movie_id, entries)
+            return True
+        except REJECTED_ERRORS:
+            traceback.print_exc()
+        except psycopg2.Error:
+            traceback.print_exc()
+            return False
+
+        for entry in entries:
+            try:
+                self._insert(username, movie_id, [entry])
+            except REJECTED_ERRORS as e:
+                self._reject(entry, e)
+            except psycopg2.Error:
+                traceback.print_exc()
+                return False
+            # Written or set aside, never written again
+            self._done([entry])
+        return True
+
+    def _reject(self, entry: dict, error: Exception):
+        """Append a save that the database rejected to the rejected file.
+        """
+        print(f"Database rejected a save of cluster {entry['cluster_id']} of movie {entry['movie_id']}: {error}")
+        with open(os.path.join(self.journal_dir, REJECTED_NAME), "a") as f:
+            # Shared by all processes
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.write(json.dumps({**entry, "error": str(error).strip()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _done(self, entries: List[dict]):
+        """Forget saves that are in the database.
+        """
+        with self.lock:
+            for entry in entries:
+                key = (entry["username"], entry["movie_id"], entry["cluster_id"])
+                remaining = [e for e in self.pending.get(key, []) if e["seq"] > entry["seq"]]
+                if remaining:
+                    self.pending[key] = remaining
+                else:
+                    self.pending.pop(key, None)
+
+    def _compact_journal(self):
+        """Rewrite the journal with only the saves that are still pending.
+        """
+        with self.lock:
+            # The new file is locked before it replaces the old one, and then
+            # becomes the journal
+            tmp_path = f"{self.journal_path}.tmp"
+            journal = open(tmp_path, "w")
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+            for entries in self.pending.values():
+                for entry in entries:
+                    journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            os.replace(tmp_path, self.journal_path)
+            self.journal.close()
+            self.journal = journal
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self.lock:
+                if not self.pending and not self.closed:
+                    self.wakeup.wait()
+                if self.closed:
+                    break
+            # Let saves that come in quick succession collect into one batch
+            time.sleep(self.flush_interval if failures == 0 else min(60, 2 ** failures))
+            try:
+                ok = self.flush()
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            failures = 0 if ok else failures + 1
+
+    def close(self, *_):
+        """Flush pending saves and close the database client. Saves that
+        can't be flushed stay in the journal for the next start.
+        """
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+        with self.lock:
+            if not self.pending and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        self.db_client.close()
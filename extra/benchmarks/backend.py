@@ -0,0 +1,181 @@
+"""Microbenchmarks of the backend's loaders and request handlers.
+
+Runs in-process on synthetic data (see synthetic_data.py): parsing *-data
+directories with and without snapshots, reading metadata, backend startup,
+and the main endpoints through FastAPI's TestClient. Labels are kept by an
+in-process stand-in for the database, or by Postgres with --db postgres (in a
+separate schema, so existing labels are not touched).
+
+Example:
+    python extra/benchmarks/backend.py --root /tmp/bench --movies 4 --trajectories 2000 --json backend.json
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+from common import BACK_DIR, timed, summary, report
+import memory_db
+import synthetic_data
+
+BENCH_SCHEMA = "video_labeler_bench"
+
+def use_postgres(args):
+    """Create the schema for benchmark labels, and make the backend use it.
+    """
+    import psycopg2
+    conn = psycopg2.connect(host=args.host, port=args.port, user="admin", database="db", password=args.password)
+    with open(os.path.join(BACK_DIR, "database", "create.sql"), "r") as f:
+        schema_sql = f.read()
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA};")
+        cursor.execute(f"SET search_path TO {BENCH_SCHEMA};")
+        cursor.execute(schema_sql)
+    conn.commit()
+    os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+    os.environ["DB_HOST"] = args.host
+    os.environ["DB_PASSWORD"] = args.password
+    return conn
+
+def drop_postgres(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE;")
+    conn.commit()
+    conn.close()
+
+def bench_loaders(backend, data_dir, films_dir, metadata_dir, repeat):
+    """Parsing of movie data and metadata, cold (no caches) and from caches.
+    """
+    import movie_data
+
+    movie_dirs = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir))
+    movie_ids = [int(os.path.basename(dir).split("-")[0]) for dir in movie_dirs]
+    results = {}
+
+    results["parse_datadir"] = timed(
+        lambda i: movie_data.parse_datadir(movie_dirs[i % len(movie_dirs)], movie_ids[i % len(movie_ids)], None, 2),
+        repeat,
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def read_datadir(i):
+            k = i % len(movie_dirs)
+            return movie_data.read_datadir(movie_dirs[k], movie_ids[k], None, cache_dir, 2)
+        # The first read of each movie saves its snapshot
+        for i in range(len(movie_dirs)):
+            read_datadir(i)
+        results["read_datadir_snapshot"] = timed(read_datadir, repeat)
+        results["read_summaries_snapshot"] = timed(
+            lambda i: movie_data.read_summaries(data_dir, films_dir, cache_dir, 2, parse=True, n_workers=1),
+            repeat,
+        )
+
+    results["read_metadata"] = timed(lambda i: backend.read_metadata(metadata_dir), repeat)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        backend.load_metadata(metadata_dir, cache_dir)
+        results["load_metadata_cached"] = timed(lambda i: backend.load_metadata(metadata_dir, cache_dir), repeat)
+    return results
+
+def bench_handlers(client, main, repeat, seed):
+    """Endpoints, called like the frontend does.
+    """
+    rng = random.Random(seed)
+    movie_ids = list(main.movie_index)
+    clusters = [(m, c) for m in movie_ids for c in main.dir_data[m]["clusters"]]
+    picks = [rng.choice(clusters) for _ in range(repeat)]
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        return response
+
+    # Image urls of the picked clusters, before anything is cached
+    cluster_data = {key: get(f"/api/faces/clusters/{key[0]}/{key[1]}").json() for key in set(picks)}
+    images = [image for key in picks for image in cluster_data[key]["images"][:1]]
+    frame_urls = [image["full_frame_url"] for image in images]
+    new_frame_urls = list(dict.fromkeys(frame_urls))
+
+    results = {}
+    # Every frame is rendered for the first time: decoding and encoding
+    results["get_frame_cold"] = timed(lambda i: get(f"/{new_frame_urls[i]}"), len(new_frame_urls))
+    results["get_frame_cached"] = timed(lambda i: get(f"/{frame_urls[i]}"), repeat)
+    results["get_image"] = timed(lambda i: get(f"/{images[i]['url']}"), repeat)
+    results["get_cluster_data"] = timed(lambda i: get(f"/api/faces/clusters/{picks[i][0]}/{picks[i][1]}"), repeat)
+    results["get_cluster_images"] = timed(
+        lambda i: get(f"/api/faces/clusters/{picks[i][0]}/{picks[i][1]}/images"), repeat
+    )
+
+    def save(i):
+        movie_id, cluster_id = picks[i]
+        data = cluster_data[picks[i]]
+        response = client.post(f"/api/faces/clusters/{movie_id}/{cluster_id}", json={
+            "label": f"a{i % 10}",
+            "status": "labeled",
+            "time": 1000,
+            "images": [{"url": image["url"], "status": "same"} for image in data["images"]],
+        })
+        assert response.status_code == 200, response.text
+    results["set_cluster_data"] = timed(save, repeat)
+
+    results["list_movies"] = timed(lambda i: get("/api/movies"), repeat)
+    results["get_movie"] = timed(lambda i: get(f"/api/movies/{picks[i][0]}"), repeat)
+    results["list_actors"] = timed(lambda i: get(f"/api/actors/{picks[i][0]}"), repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--root", help="synthetic data from synthetic_data.py, generated here if missing (default: a temporary directory)")
+    synthetic_data.add_arguments(parser)
+    parser.add_argument("--db", choices=["memory", "postgres"], default="memory")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="added to each call of the in-process database")
+    parser.add_argument("--host", default=os.environ.get("DB_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--password", default=os.environ.get("DB_PASSWORD", ""))
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    root = args.root or tmp_dir.name
+    if not os.path.isdir(os.path.join(root, "data")):
+        start = time.perf_counter()
+        synthetic_data.generate_from_args(root, args)
+        print(f"Generated data in {time.perf_counter() - start:.1f}s")
+    data_dir, films_dir, metadata_dir = (os.path.join(root, name) for name in ("data", "films", "metadata"))
+
+    sys.path.insert(0, BACK_DIR)
+    os.environ.update({
+        "DATA_DIR": data_dir,
+        "FILMS_DIR": films_dir,
+        "METADATA_DIR": metadata_dir,
+        "CACHE_DIR": os.path.join(tmp_dir.name, "cache"),
+        # Background rendering would make frame timings depend on the order of requests
+        "PREFETCH_CLUSTERS": "-1",
+    })
+    conn = use_postgres(args) if args.db == "postgres" else None
+    if conn is None:
+        memory_db.install(args.db_latency_ms)
+        os.environ.setdefault("DB_PASSWORD", "")
+
+    # Startup with empty caches: metadata, parsing and snapshots of all movies
+    start = time.perf_counter()
+    import main as backend
+    results = {"startup": [1000 * (time.perf_counter() - start)]}
+
+    results.update(bench_loaders(backend, data_dir, films_dir, metadata_dir, max(1, args.repeat // 20)))
+
+    from fastapi.testclient import TestClient
+    client = TestClient(backend.app)
+    results.update(bench_handlers(client, backend, args.repeat, args.seed))
+
+    backend.db_client.close()
+    if conn is not None:
+        drop_postgres(conn)
+    tmp_dir.cleanup()
+
+    report(vars(args), {name: summary(latencies) for name, latencies in results.items()}, args.json)
+
+if __name__ == "__main__":
+    main()
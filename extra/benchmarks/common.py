@@ -0,0 +1,59 @@
+"""Helpers shared by the benchmarks: timing, summaries and JSON reports.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+BACK_DIR = os.path.join(REPO_DIR, "back")
+
+def timed(fn, repeat):
+    """Run fn(i) repeat times, return latencies in milliseconds.
+    """
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(1000 * (time.perf_counter() - start))
+    return latencies
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[round(0.95 * (len(latencies) - 1))], 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "n": len(latencies),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(params: dict, results: dict, json_path=None):
+    """Print results (name -> summary), and write them with the parameters and
+    the commit to json_path, so that runs can be compared between commits.
+    """
+    for name, stats in results.items():
+        extra = f"   {stats['rps']:>8.1f} req/s" if "rps" in stats else ""
+        print(f"{name:<28} p50 {stats['p50_ms']:>9.3f} ms   p95 {stats['p95_ms']:>9.3f} ms{extra}")
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "params": {k: v for k, v in params.items() if k not in ("password", "json")},
+                "results": results,
+            }, f, indent=2)
@@ -0,0 +1,30 @@
+"""Compare two JSON results of a benchmark, e.g. from two commits.
+
+Example: python extra/benchmarks/compare.py before.json after.json
+"""
+import json
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="p50_ms", help="p50_ms, p95_ms, mean_ms or rps")
+    args = parser.parse_args()
+
+    with open(args.before, "r") as f:
+        before = json.load(f)
+    with open(args.after, "r") as f:
+        after = json.load(f)
+
+    print(f"{'':<28} {before.get('commit') or 'before':>12} {after.get('commit') or 'after':>12}   change")
+    for name, stats in after["results"].items():
+        old = before["results"].get(name, {}).get(args.metric)
+        new = stats.get(args.metric)
+        if old is None or new is None:
+            continue
+        change = f"{100 * (new - old) / old:+.1f}%" if old else ""
+        print(f"{name:<28} {old:>12.3f} {new:>12.3f}   {change}")
+
+if __name__ == "__main__":
+    main()
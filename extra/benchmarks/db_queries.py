@@ -0,0 +1,106 @@
+"""Per-request latency of the DatabaseClient queries at realistic table sizes.
+
+Creates the schema from back/database/create.sql in a separate Postgres schema
+(so existing tables are not touched), fills it with synthetic labels, and times
+the queries that the backend runs on cluster views, saves and listings. The
+schema is dropped afterwards.
+
+Example:
+    python extra/benchmarks/db_queries.py --host localhost --password test \
+        --movies 100 --clusters 2000 --users 2 --json results.json
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import psycopg2
+
+from common import BACK_DIR, timed, summary, report
+sys.path.insert(0, BACK_DIR)
+from database_client import DatabaseClient
+
+BENCH_SCHEMA = "video_labeler_bench"
+
+def populate(conn, schema_sql, n_movies, n_clusters, n_users, n_images):
+    """Create tables and fill them with n_users labels for every cluster.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA};")
+        cursor.execute(f"SET search_path TO {BENCH_SCHEMA};")
+        cursor.execute(schema_sql)
+        cursor.execute("""INSERT INTO
+            clusters (username, movie_id, cluster_id, status, label, n_images, processing_time)
+            SELECT 'user' || u, m, c, 'labeled', 'actor' || (c %% 50), %s, 1000
+            FROM generate_series(1, %s) AS u, generate_series(1, %s) AS m,
+                generate_series(0, %s - 1) AS c;
+        """, (n_images, n_users, n_movies, n_clusters))
+        cursor.execute("""INSERT INTO images (cluster_id, tag, status, trajectory)
+            SELECT id, movie_id || ':' || k || ':10_20_30_40', 'same', k
+            FROM clusters, generate_series(0, n_images - 1) AS k;
+        """)
+        cursor.execute("ANALYZE;")
+    conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default=os.environ.get("DB_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--database", default="db")
+    parser.add_argument("--password", default=os.environ.get("DB_PASSWORD", ""))
+    parser.add_argument("--schema-sql", default=os.path.join(BACK_DIR, "database", "create.sql"))
+    parser.add_argument("--movies", type=int, default=100)
+    parser.add_argument("--clusters", type=int, default=2000, help="clusters per movie")
+    parser.add_argument("--users", type=int, default=2, help="labels per cluster")
+    parser.add_argument("--images", type=int, default=10, help="images per cluster")
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    conn_args = dict(
+        host=args.host, port=args.port, user=args.user, database=args.database, password=args.password
+    )
+    conn = psycopg2.connect(**conn_args)
+    with open(args.schema_sql, "r") as f:
+        schema_sql = f.read()
+
+    start = time.perf_counter()
+    populate(conn, schema_sql, args.movies, args.clusters, args.users, args.images)
+    print(f"Populated in {time.perf_counter() - start:.1f}s")
+
+    # Connections made by the client (libpq) only see the benchmark schema
+    os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+    db = DatabaseClient(**conn_args, pool_size=2)
+
+    random.seed(0)
+    movie_ids = [random.randint(1, args.movies) for _ in range(args.repeat)]
+    cluster_ids = [random.randint(0, args.clusters - 1) for _ in range(args.repeat)]
+    images = [(f"1:{k}:10_20_30_40", "same", k) for k in range(args.images)]
+
+    results = {
+        "get_annotations": timed(
+            lambda i: db.get_annotations("user1", movie_ids[i], cluster_ids[i]), args.repeat
+        ),
+        "insert_annotations": timed(
+            lambda i: db.insert_annotations(
+                "user1", movie_ids[i], cluster_ids[i], "actor1", images, "labeled", 1000
+            ),
+            args.repeat,
+        ),
+        "get_annotation_counts": timed(lambda i: db.get_annotation_counts(), args.repeat),
+        "get_actor_counts": timed(lambda i: db.get_actor_counts(movie_ids[i]), args.repeat),
+    }
+    db.close()
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE;")
+    conn.commit()
+    conn.close()
+
+    report(vars(args), {name: summary(latencies) for name, latencies in results.items()}, args.json)
+
+if __name__ == "__main__":
+    main()
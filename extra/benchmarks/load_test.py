@@ -0,0 +1,155 @@
+"""Concurrent HTTP load test of the backend.
+
+Simulated annotators go through clusters of a movie like the frontend does:
+open a cluster (data and face images), look at a full frame, save the cluster
+and refresh the movie. Reports latencies and throughput per route.
+
+The backend is started by this script on synthetic data, with the in-process
+stand-in for the database (see serve.py), unless --url points to a running one.
+
+Examples:
+    python extra/benchmarks/load_test.py --concurrency 16 --duration 30 --json load.json
+    python extra/benchmarks/load_test.py --url http://localhost:5000 --concurrency 8
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from collections import defaultdict
+
+from common import summary, report
+import synthetic_data
+
+class Annotator(threading.Thread):
+    def __init__(self, url: str, k: int, movies, deadline: float, per_image: bool, results, lock):
+        super().__init__(daemon=True)
+        parsed = urllib.parse.urlparse(url)
+        # One keep-alive connection per annotator, like a browser
+        self.conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+        self.username = f"bench{k}"
+        self.rng = random.Random(k)
+        self.movies = movies
+        self.deadline = deadline
+        self.per_image = per_image
+        self.results = results
+        self.lock = lock
+
+    def request(self, name, method, path, body=None):
+        headers = {"Connection": "keep-alive"}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            content = response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            content, ok = None, False
+        latency = 1000 * (time.perf_counter() - start)
+        with self.lock:
+            self.results[name if ok else f"{name} (errors)"].append(latency)
+        return content if ok else None
+
+    def run(self):
+        movie = self.rng.choice(self.movies)
+        cluster_id = self.rng.randrange(movie["n_clusters"])
+        while time.time() < self.deadline:
+            path = f"/api/faces/clusters/{movie['id']}/{cluster_id}"
+            content = self.request("get_cluster_data", "GET", path)
+            if content is not None:
+                cluster = json.loads(content)
+                if self.per_image:
+                    for image in cluster["images"]:
+                        self.request("get_image", "GET", f"/{image['url']}")
+                else:
+                    self.request("get_cluster_images", "GET", f"{path}/images")
+                if cluster["images"]:
+                    image = self.rng.choice(cluster["images"])
+                    self.request("get_frame", "GET", f"/{image['full_frame_url']}")
+                self.request("set_cluster_data", "POST", path, {
+                    "label": f"a{self.rng.randrange(20)}",
+                    "status": "labeled",
+                    "time": 1000,
+                    "images": [{"url": image["url"], "status": "same"} for image in cluster["images"]],
+                })
+            self.request("get_movie", "GET", f"/api/movies/{movie['id']}")
+            cluster_id = (cluster_id + 1) % movie["n_clusters"]
+
+def wait_for(url: str, timeout: float):
+    parsed = urllib.parse.urlparse(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=5)
+            conn.request("GET", "/api/movies")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    sys.exit(f"Backend did not start at {url}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="running backend (default: start one on synthetic data)")
+    parser.add_argument("--root", help="synthetic data for the started backend, generated here if missing")
+    synthetic_data.add_arguments(parser)
+    parser.add_argument("--port", type=int, default=5099, help="port of the started backend")
+    parser.add_argument("--concurrency", type=int, default=8, help="simulated annotators")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--per-image", action="store_true", help="load face images one by one, instead of per cluster")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    server, tmp_dir = None, tempfile.TemporaryDirectory()
+    url = args.url
+    if url is None:
+        root = args.root or tmp_dir.name
+        if not os.path.isdir(os.path.join(root, "data")):
+            synthetic_data.generate_from_args(root, args)
+        url = f"http://127.0.0.1:{args.port}"
+        server = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py"),
+            root, "--port", str(args.port), "--cache-dir", os.path.join(tmp_dir.name, "cache"),
+        ])
+    try:
+        wait_for(url, timeout=300)
+        parsed = urllib.parse.urlparse(url)
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+        conn.request("GET", "/api/movies")
+        movies = [movie for movie in json.loads(conn.getresponse().read()) if movie["n_clusters"] > 0]
+
+        results, lock = defaultdict(list), threading.Lock()
+        deadline = time.time() + args.duration
+        annotators = [
+            Annotator(url, k, movies, deadline, args.per_image, results, lock) for k in range(args.concurrency)
+        ]
+        start = time.perf_counter()
+        for annotator in annotators:
+            annotator.start()
+        for annotator in annotators:
+            annotator.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        tmp_dir.cleanup()
+
+    stats = {}
+    for name, latencies in sorted(results.items()):
+        stats[name] = {**summary(latencies), "rps": round(len(latencies) / elapsed, 1)}
+    report(vars(args), stats, args.json)
+
+if __name__ == "__main__":
+    main()
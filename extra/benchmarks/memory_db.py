@@ -0,0 +1,107 @@
+"""In-process stand-in for DatabaseClient, for benchmarking the backend
+without Postgres. Same methods and results as DatabaseClient, with the labels
+kept in dicts and the counts computed when read.
+"""
+from collections import defaultdict
+import time
+import threading
+
+class MemoryDatabaseClient:
+    def __init__(self, *args, latency_ms=0.0, **kwargs):
+        # Added to each call, to simulate the round-trip to a database
+        self.latency = latency_ms / 1000
+        self.lock = threading.Lock()
+        # (movie_id, cluster_id) -> username -> cluster record, oldest first
+        self.clusters = defaultdict(dict)
+
+    def close(self, *_):
+        pass
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def insert_annotations(self, username, movie_id, cluster_id, label, images, status, time):
+        return self.insert_annotations_batch(
+            username, movie_id, [(cluster_id, label, images, status, time)]
+        )
+
+    def insert_annotations_batch(self, username, movie_id, annotations, raise_errors=False):
+        self._wait()
+        with self.lock:
+            for cluster_id, label, images, status, processing_time in annotations:
+                records = self.clusters[(movie_id, cluster_id)]
+                if label is None and status == "labeled" and all(img[1] == "same" for img in images):
+                    records.pop(username, None)
+                    continue
+                previous = records.get(username)
+                records[username] = {
+                    "username": username,
+                    "label": label,
+                    "status": status,
+                    "created_on": int(time.time()),
+                    "images": [(tag, image_status) for tag, image_status, _ in images],
+                    "processing_time": processing_time + (previous["processing_time"] if previous else 0),
+                }
+        return True
+
+    def get_annotations(self, username, movie_id, cluster_id):
+        annotations = self.get_annotations_batch(username, movie_id, [cluster_id])
+        return annotations.get(cluster_id, {})
+
+    def get_annotations_batch(self, username, movie_id, cluster_ids):
+        self._wait()
+        annotations = {}
+        with self.lock:
+            for cluster_id in cluster_ids:
+                records = self.clusters.get((movie_id, cluster_id))
+                if not records:
+                    continue
+                # The user's own annotation is preferred, then the oldest one
+                record = records.get(username) or next(iter(records.values()))
+                annotations[cluster_id] = {
+                    "movie_id": movie_id,
+                    "cluster_id": cluster_id,
+                    "username": record["username"],
+                    "label": record["label"],
+                    "status": record["status"],
+                    "created_on": record["created_on"],
+                    "images": list(record["images"]),
+                }
+        return annotations
+
+    def get_annotation_counts(self, movie_id=None):
+        self._wait()
+        with self.lock:
+            labeled = [
+                key_movie_id for (key_movie_id, _), records in self.clusters.items()
+                if movie_id in (None, key_movie_id) and any(r["label"] is not None for r in records.values())
+            ]
+        counts = defaultdict(lambda: 0)
+        for key_movie_id in labeled:
+            counts[key_movie_id] += 1
+        return counts
+
+    def get_actor_counts(self, movie_id: int):
+        self._wait()
+        count_global, count_movie = defaultdict(lambda: 0), defaultdict(lambda: 0)
+        with self.lock:
+            records = [
+                (key_movie_id, record) for (key_movie_id, _), records in self.clusters.items()
+                for record in records.values()
+            ]
+        for key_movie_id, record in records:
+            if record["label"] is None or record["status"] != "labeled":
+                continue
+            n_same = sum(status == "same" for _, status in record["images"])
+            count_global[record["label"]] += n_same
+            if key_movie_id == movie_id:
+                count_movie[record["label"]] += n_same
+        return count_global, count_movie
+
+def install(latency_ms=0.0):
+    """Make the backend create this client instead of DatabaseClient. Call
+    before importing the backend's main module.
+    """
+    import database_client
+    database_client.DatabaseClient = lambda *args, **kwargs: MemoryDatabaseClient(latency_ms=latency_ms)
@@ -0,0 +1,38 @@
+"""Run the backend on synthetic data, with the in-process stand-in for the
+database (memory_db.py), for load tests without Postgres.
+
+Example: python extra/benchmarks/serve.py /tmp/bench --port 5099
+"""
+import os
+import sys
+import argparse
+
+from common import BACK_DIR
+import memory_db
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("root", help="synthetic data from synthetic_data.py")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--cache-dir", help="CACHE_DIR of the backend (default: its own default)")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="added to each database call")
+    args = parser.parse_args()
+
+    os.environ.update({
+        "DATA_DIR": os.path.join(args.root, "data"),
+        "FILMS_DIR": os.path.join(args.root, "films"),
+        "METADATA_DIR": os.path.join(args.root, "metadata"),
+    })
+    os.environ.setdefault("DB_PASSWORD", "")
+    if args.cache_dir:
+        os.environ["CACHE_DIR"] = args.cache_dir
+
+    sys.path.insert(0, BACK_DIR)
+    memory_db.install(args.db_latency_ms)
+    import main as backend
+
+    import uvicorn
+    uvicorn.run(backend.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
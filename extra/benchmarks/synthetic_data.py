@@ -0,0 +1,135 @@
+"""Generate synthetic input data for the backend at a configurable scale.
+
+Writes the three directories that the backend reads:
+    <root>/data/<movie_id>-data: trajectories.jsonl, clusters.json,
+        predictions.json and images/ (face images), like the extraction pipeline
+    <root>/films/<movie_id>-Movie<k>.mp4: short test films
+    <root>/metadata: actors.csv, actor_images.csv, aspect_ratios.csv and actor_images/
+
+Example:
+    python extra/benchmarks/synthetic_data.py /tmp/bench --movies 10 --trajectories 2000
+    DATA_DIR=/tmp/bench/data FILMS_DIR=/tmp/bench/films METADATA_DIR=/tmp/bench/metadata ...
+"""
+import os
+import json
+import random
+import argparse
+
+import numpy as np
+import cv2
+
+FIRST_MOVIE_ID = 100000
+
+def write_film(path: str, n_frames: int, width: int, height: int, fps=25.0):
+    """Film where each frame shows its own index, with a keyframe every second.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for i in range(n_frames):
+        frame = np.full((height, width, 3), (i * 7) % 256, dtype=np.uint8)
+        cv2.putText(frame, str(i), (10, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+
+def write_movie_data(dir: str, movie_id: int, rng: random.Random, n_trajectories: int, n_clusters: int,
+                     n_frames: int, width: int, height: int, image_fraction: float, actor_ids):
+    """One *-data directory. Trajectories are runs of slowly moving boxes, and
+    image_fraction of their boxes have a face image.
+    """
+    images_dir = os.path.join(dir, "images")
+    os.makedirs(images_dir, exist_ok=True)
+    _, face = cv2.imencode(".jpeg", np.full((64, 64, 3), 128, dtype=np.uint8))
+    face = face.tobytes()
+
+    clusters = []
+    with open(os.path.join(dir, "trajectories.jsonl"), "w") as f:
+        for ti in range(n_trajectories):
+            length = rng.randint(5, 50)
+            start = rng.randint(0, max(0, n_frames - length))
+            size = rng.randint(40, max(41, min(width, height) // 3))
+            x, y = rng.randint(0, width - size), rng.randint(0, height - size)
+            bbs = []
+            for k in range(length):
+                x1, y1 = min(width - size, x + k), y
+                bbs.append([x1, y1, x1 + size, y1 + size])
+                if rng.random() < image_fraction:
+                    with open(os.path.join(images_dir, f"{movie_id}:{start + k}:{x1}_{y1}_{x1 + size}_{y1 + size}.jpeg"), "wb") as image:
+                        image.write(face)
+            f.write(json.dumps({"index": ti, "start": start, "bbs": bbs}) + "\n")
+            # Every cluster has at least one trajectory
+            clusters.append(ti if ti < n_clusters else rng.randrange(n_clusters))
+
+    with open(os.path.join(dir, "clusters.json"), "w") as f:
+        json.dump({"clusters": clusters}, f)
+
+    predictions = {
+        str(c): {actor_id: round(rng.random(), 3) for actor_id in rng.sample(actor_ids, min(3, len(actor_ids)))}
+        for c in sorted(set(clusters))
+    }
+    with open(os.path.join(dir, "predictions.json"), "w") as f:
+        json.dump({"predictions": predictions}, f)
+
+def generate(root: str, n_movies: int, n_trajectories: int, n_clusters: int, n_frames: int,
+             n_actors: int, width=320, height=240, image_fraction=0.5, seed=0):
+    rng = random.Random(seed)
+    data_dir, films_dir, metadata_dir = (os.path.join(root, name) for name in ("data", "films", "metadata"))
+    actor_images_dir = os.path.join(metadata_dir, "actor_images")
+    for dir in (data_dir, films_dir, actor_images_dir):
+        os.makedirs(dir, exist_ok=True)
+
+    _, actor_image = cv2.imencode(".jpg", np.full((100, 80, 3), 200, dtype=np.uint8))
+    actor_rows, actor_image_rows, aspect_rows = [], [], []
+    for k in range(n_movies):
+        movie_id = FIRST_MOVIE_ID + k
+        film_name = f"{movie_id}-Movie{k}.mp4"
+        write_film(os.path.join(films_dir, film_name), n_frames, width, height)
+        aspect_rows.append(f"{film_name},{width},{height}")
+
+        actor_ids = [f"a{(k + i) % (3 * n_actors)}" for i in range(n_actors)]
+        for i, actor_id in enumerate(actor_ids):
+            actor_rows.append(f"{movie_id},Movie {k},{1950 + k % 50},{actor_id},Actor {actor_id},Role {i},1920-01-01,Helsinki")
+            image_name = f"{actor_id}_{movie_id}.jpg"
+            actor_image_rows.append(f"{len(actor_image_rows)},{actor_id},{movie_id},{image_name},{rng.randint(1, 20)}")
+            with open(os.path.join(actor_images_dir, image_name), "wb") as f:
+                f.write(actor_image.tobytes())
+
+        write_movie_data(
+            os.path.join(data_dir, f"{movie_id}-data"), movie_id, rng, n_trajectories,
+            n_clusters, n_frames, width, height, image_fraction, actor_ids,
+        )
+        print(f"Generated movie {movie_id} ({k + 1}/{n_movies})")
+
+    with open(os.path.join(metadata_dir, "actors.csv"), "w") as f:
+        f.write("movie_id,movie_name,movie_year,id,name,role,birthday,birthplace\n")
+        f.write("\n".join(actor_rows) + "\n")
+    with open(os.path.join(metadata_dir, "actor_images.csv"), "w") as f:
+        f.write("index,actor_id,movie_id,filename,n_detections\n")
+        f.write("\n".join(actor_image_rows) + "\n")
+    with open(os.path.join(metadata_dir, "aspect_ratios.csv"), "w") as f:
+        f.write("filename,display_width,display_height\n")
+        f.write("\n".join(aspect_rows) + "\n")
+    return data_dir, films_dir, metadata_dir
+
+def add_arguments(parser):
+    parser.add_argument("--movies", type=int, default=2)
+    parser.add_argument("--trajectories", type=int, default=500, help="trajectories per movie")
+    parser.add_argument("--clusters", type=int, default=100, help="clusters per movie")
+    parser.add_argument("--frames", type=int, default=1500, help="length of the films, in frames")
+    parser.add_argument("--actors", type=int, default=20, help="actors per movie")
+    parser.add_argument("--image-fraction", type=float, default=0.5, help="boxes that have a face image")
+    parser.add_argument("--seed", type=int, default=0)
+
+def generate_from_args(root: str, args):
+    return generate(
+        root, args.movies, args.trajectories, min(args.clusters, args.trajectories), args.frames,
+        args.actors, image_fraction=args.image_fraction, seed=args.seed,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("root", help="directory to write data/, films/ and metadata/ into")
+    add_arguments(parser)
+    args = parser.parse_args()
+    generate_from_args(args.root, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Export labels from the PostgreSQL database to CSV or Parquet.
+
+Rows are streamed from the database and written in chunks, so memory use
+doesn't grow with the number of labels. There is one row per labeled image,
+with the columns of its cluster and image. Clusters that were reset to their
+initial state are not exported.
+
+Incremental exports: --since and --after-id select labels that were saved or
+created after an earlier export. The values for the next export are printed at
+the end. Saving a cluster again updates its created_on but keeps its id, so
+--since also picks up changed labels, while --after-id only picks up new ones.
+
+With --data-dir, the images are joined with the trajectories of the movies
+(like the backend's trajectory_map), so that the export can be used as a
+training set directly: frame and box of each image, the path of its face
+image, and the first frame and length of its trajectory.
+
+Examples:
+    python extra/export_labels.py --password test labels.csv
+    python extra/export_labels.py --password test --movie 1234 --since 1700000000 new.parquet
+    python extra/export_labels.py --password test --data-dir /path/to/data train.csv
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+BACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back")
+
+COLUMNS = [
+    ("id", "int64"),
+    ("username", "string"),
+    ("movie_id", "int64"),
+    ("cluster_id", "int64"),
+    ("cluster_status", "string"),
+    ("label", "string"),
+    ("n_images", "int64"),
+    ("created_on", "float64"),
+    ("processing_time", "int64"),
+    ("id_ref", "int64"),
+    ("tag", "string"),
+    ("image_status", "string"),
+    ("trajectory", "int64"),
+]
+TRAJECTORY_COLUMNS = [
+    ("frame", "int64"),
+    ("x1", "int64"),
+    ("y1", "int64"),
+    ("x2", "int64"),
+    ("y2", "int64"),
+    ("image_path", "string"),
+    ("trajectory_start", "float64"),
+    ("trajectory_length", "float64"),
+]
+
+def build_query(since=None, after_id=None, movies=None, users=None):
+    """Query and parameters for the exported rows, oldest clusters first.
+    """
+    conditions = ["(status <> 'labeled' OR label IS NOT NULL)"]
+    params = {}
+    if since is not None:
+        conditions.append("EXTRACT(EPOCH FROM created_on) > %(since)s")
+        params["since"] = since
+    if after_id is not None:
+        conditions.append("id > %(after_id)s")
+        params["after_id"] = after_id
+    if movies:
+        conditions.append("movie_id = ANY(%(movies)s)")
+        params["movies"] = list(movies)
+    if users:
+        conditions.append("username = ANY(%(users)s)")
+        params["users"] = list(users)
+
+    query = f"""SELECT clusters.*, images.*
+        FROM (
+            SELECT id,username,movie_id,cluster_id,status as cluster_status,label,n_images,
+                EXTRACT(EPOCH FROM created_on)::double precision as created_on,processing_time
+            FROM clusters
+            WHERE {" AND ".join(conditions)}
+        ) AS clusters
+        INNER JOIN (
+            SELECT cluster_id as id_ref,tag,status as image_status,trajectory FROM images
+        ) AS images
+        ON (clusters.id = images.id_ref)
+        ORDER BY clusters.id"""
+    return query, params
+
+class TrajectoryJoin:
+    """Adds frame, box, image path and trajectory columns to exported rows,
+    from the *-data directories of the movies.
+    """
+    def __init__(self, data_dir: str):
+        sys.path.insert(0, BACK_DIR)
+        from movie_data import read_trajectories
+        self.read_trajectories = read_trajectories
+        self.data_dir = data_dir
+        # movie_id -> (starts, lengths), or None if the movie has no data
+        self.trajectories = {}
+
+    def movie_trajectories(self, movie_id: int):
+        if movie_id not in self.trajectories:
+            path = os.path.join(self.data_dir, f"{movie_id}-data", "trajectories.jsonl")
+            if os.path.exists(path):
+                starts, offsets, _ = self.read_trajectories(path)
+                self.trajectories[movie_id] = (starts, np.diff(offsets))
+            else:
+                print(f"No trajectories for movie {movie_id}: {path}")
+                self.trajectories[movie_id] = None
+        return self.trajectories[movie_id]
+
+    def __call__(self, df: pd.DataFrame):
+        # Tags are like 121614:3616:235_183_293_262, see img_tag
+        parts = df["tag"].str.split(":", n=2, expand=True)
+        boxes = parts[2].str.split("_", expand=True)
+        df["frame"] = parts[1].astype("int64")
+        for i, name in enumerate(["x1", "y1", "x2", "y2"]):
+            df[name] = boxes[i].astype("int64")
+        df["image_path"] = [
+            os.path.join(self.data_dir, f"{movie_id}-data", "images", f"{tag}.jpeg")
+            for movie_id, tag in zip(df["movie_id"], df["tag"])
+        ]
+
+        df["trajectory_start"] = np.nan
+        df["trajectory_length"] = np.nan
+        for movie_id, rows in df.groupby("movie_id").groups.items():
+            trajectories = self.movie_trajectories(int(movie_id))
+            if trajectories is None:
+                continue
+            starts, lengths = trajectories
+            ids = df.loc[rows, "trajectory"].to_numpy()
+            known = (ids >= 0) & (ids < len(starts))
+            df.loc[rows[known], "trajectory_start"] = starts[ids[known]]
+            df.loc[rows[known], "trajectory_length"] = lengths[ids[known]]
+        return df
+
+class CsvWriter:
+    def __init__(self, path: str, columns):
+        self.f = open(path, "w", newline="")
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        df.to_csv(self.f, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.f.close()
+
+class ParquetWriter:
+    def __init__(self, path: str, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Parquet export needs pyarrow: pip install pyarrow")
+        types = {"int64": pa.int64(), "float64": pa.float64(), "string": pa.string()}
+        self.pa = pa
+        self.schema = pa.schema([(name, types[dtype]) for name, dtype in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, df: pd.DataFrame):
+        table = self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+def export_copy(conn, query, params, path):
+    """Plain CSV export: Postgres writes the CSV, and it's streamed to the file.
+    """
+    with conn.cursor() as cursor:
+        copy = cursor.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params)
+        with open(path, "w", newline="") as f:
+            cursor.copy_expert(copy.decode(), f)
+
+def export_chunks(conn, query, params, writer, chunk_size, transform=None):
+    """Read rows with a server-side cursor, chunk_size rows at a time.
+    Returns the number of rows, and the largest created_on and id seen.
+    """
+    n_rows, max_created_on, max_id = 0, None, None
+    names = [name for name, _ in COLUMNS]
+    dtypes = dict(COLUMNS)
+    # Named cursors are server-side: rows are only sent when fetched
+    with conn.cursor(name="export_labels") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            df = pd.DataFrame.from_records(rows, columns=names).astype(dtypes)
+            n_rows += len(df)
+            max_id = max(max_id or 0, int(df["id"].max()))
+            max_created_on = max(max_created_on or 0, float(df["created_on"].max()))
+            if transform is not None:
+                df = transform(df)
+            writer.write(df)
+    return n_rows, max_created_on, max_id
+
+def query_watermark(conn, query, params):
+    """Largest created_on and id of the rows that a COPY export wrote.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT MAX(created_on), MAX(id), COUNT(*) FROM ({query}) AS exported", params)
+        max_created_on, max_id, n_rows = cursor.fetchone()
+    return n_rows, max_created_on, max_id
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output", nargs="?", default="labels.csv", help="a .csv or .parquet file")
+    parser.add_argument("--host", default=os.environ.get("DB_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--database", default="db")
+    parser.add_argument("--password", default=os.environ.get("DB_PASSWORD", ""))
+    parser.add_argument("--format", choices=["csv", "parquet"], help="default: from the output file name")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="rows per chunk")
+    parser.add_argument("--since", type=float, help="only clusters saved after this time (seconds since epoch, like created_on)")
+    parser.add_argument("--after-id", type=int, help="only clusters with a larger id")
+    parser.add_argument("--movie", type=int, action="append", help="only this movie (can be repeated)")
+    parser.add_argument("--username", action="append", help="only labels of this user (can be repeated)")
+    parser.add_argument("--data-dir", help="join with trajectories of the movies in this directory")
+    args = parser.parse_args()
+
+    format = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    query, params = build_query(args.since, args.after_id, args.movie, args.username)
+
+    conn = psycopg2.connect(
+        user=args.user,
+        password=args.password,
+        host=args.host,
+        port=args.port,
+        database=args.database,
+    )
+    # One snapshot of the database for the export and its watermark
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        if format == "csv" and args.data_dir is None:
+            export_copy(conn, query, params, args.output)
+            n_rows, max_created_on, max_id = query_watermark(conn, query, params)
+        else:
+            columns = COLUMNS + (TRAJECTORY_COLUMNS if args.data_dir else [])
+            writer = (ParquetWriter if format == "parquet" else CsvWriter)(args.output, columns)
+            transform = TrajectoryJoin(args.data_dir) if args.data_dir else None
+            try:
+                n_rows, max_created_on, max_id = export_chunks(
+                    conn, query, params, writer, args.chunk_size, transform
+                )
+            finally:
+                writer.close()
+        conn.rollback()
+    finally:
+        conn.close()
+
+    print(f"Exported {n_rows} rows to {args.output}")
+    if n_rows > 0:
+        # Labels are saved with the time their transaction started, so a save
+        # that was still running during this export can have an older time.
+        # Stop saving (or overlap the exports a bit) to not miss any.
+        print(f"Next incremental export: --since {max_created_on} or --after-id {max_id}")
+
+if __name__ == "__main__":
+    main()
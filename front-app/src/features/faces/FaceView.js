@@ -190,7 +190,7 @@ class FaceView extends Component {
               title={hoverTitle}
             ></div>
             <img
-              src={`${backendUrl}/${imageData.url}`}
+              src={imageData.blobUrl || `${backendUrl}/${imageData.url}`}
               className="faceimg"
               key={imageData.url + i}
               alt={`Original URL: ${imageData.url}`}
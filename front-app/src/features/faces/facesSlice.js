@@ -1,5 +1,7 @@
 import { createSlice } from '@reduxjs/toolkit'
+import axios from 'axios'
 import client from 'app/client'
+import backendUrl from 'app/backendUrl'
 import { fetchMovieAsync } from 'features/sidebar/sidebarSlice'
 
 // Cluster and image statuses that match those of the database
@@ -17,7 +19,7 @@ export const facesSlice = createSlice({
     clusterShowTime: null,  // number, unix time in milliseconds when cluster appeared
     labelTime: null, // integer, time in milliseconds
     clusterUser: null,  // who labeled the cluster, if anyone
-    images: [], // {url, status}
+    images: [], // {url, status, blobUrl}
     actors: [], // {id, name}
     selectedActorId: null, // label
     predictedActors: [], // list of actor ids (int)
@@ -39,6 +41,13 @@ export const facesSlice = createSlice({
       state.clusterShowTime = (new Date()).getTime()
       state.clusterUser = action.payload.username
     },
+    setBlobUrls: (state, action) => {
+      action.payload.forEach((blobUrl, i) => {
+        if (blobUrl !== null) {
+          state.images[i].blobUrl = blobUrl
+        }
+      })
+    },
     setActors: (state, action) => {
       state.actors = action.payload.actors
     },
@@ -67,17 +76,54 @@ export const facesSlice = createSlice({
   }
 })
 
-const { setCluster } = facesSlice.actions
+const { setCluster, setBlobUrls } = facesSlice.actions
 export const { toggleImage, setActors, setSelectedActor, setStatus } = facesSlice.actions
 
 // The function below is called a thunk and allows us to perform async logic. It
 // can be dispatched like a regular action: `dispatch(incrementAsync(10))`. This
 // will call the thunk with the `dispatch` function as the first argument. Async
 // code can then be executed and other actions can be dispatched
+// Object URLs of the face images of the current cluster
+let clusterBlobUrls = []
+// Number of the latest cluster request, responses to older ones are ignored
+let clusterRequest = 0
+
+// All face images of a cluster in one request: each image is a 4-byte
+// big-endian length followed by the jpeg. Resolves to a list of blobs
+// (null for missing images), or null if the request failed.
+const fetchClusterImages = (movieId, clusterId) => {
+  const url = `${backendUrl}/api/faces/clusters/${movieId}/${clusterId}/images`
+  return axios.get(url, {responseType: 'arraybuffer', timeout: 10000})
+    .then(response => {
+      const view = new DataView(response.data)
+      const blobs = []
+      let offset = 0
+      while (offset < view.byteLength) {
+        const length = view.getUint32(offset)
+        const bytes = response.data.slice(offset + 4, offset + 4 + length)
+        blobs.push(length > 0 ? new Blob([bytes], {type: 'image/jpeg'}) : null)
+        offset += 4 + length
+      }
+      return blobs
+    })
+    .catch(_ => null)
+}
+
 export const fetchClusterAsync = (movieId, clusterId) => dispatch => {
-  client.get(`faces/clusters/${movieId}/${clusterId}`)
+  const request = ++clusterRequest
+  const clusterPromise = client.get(`faces/clusters/${movieId}/${clusterId}`)
+  const imagesPromise = fetchClusterImages(movieId, clusterId)
+
+  // The cluster is shown right away with image urls, the blobs of the bundle
+  // replace them when it arrives
+  clusterPromise
     .then(response => {
+      if (request !== clusterRequest) {
+        return
+      }
       const cluster = response.data
+      clusterBlobUrls.forEach(url => URL.revokeObjectURL(url))
+      clusterBlobUrls = []
       dispatch(setCluster(cluster))
       const selectedActor = {selectedActorId: cluster.label, markDirty: false}
       dispatch(setSelectedActor(selectedActor))
@@ -86,6 +132,18 @@ export const fetchClusterAsync = (movieId, clusterId) => dispatch => {
       const newUrl = `/movies/${movieId}/clusters/${clusterId + 1}`
       window.history.replaceState(null, document.title, window.location.origin + newUrl)
     })
+
+  Promise.all([clusterPromise, imagesPromise])
+    .then(([response, blobs]) => {
+      // Without blobs, images are loaded one by one from their urls
+      if (request !== clusterRequest || blobs === null || blobs.length !== response.data.images.length) {
+        return
+      }
+      const blobUrls = blobs.map(blob => blob !== null ? URL.createObjectURL(blob) : null)
+      clusterBlobUrls = blobUrls.filter(url => url !== null)
+      dispatch(setBlobUrls(blobUrls))
+    })
+    .catch(_ => {})
 }
 
 export const sendClusterAsync = (movieId, cluster) => dispatch => {